@@ -0,0 +1,305 @@
+#
+# CPython stand-ins for the Micropython modules used by the ftp servers,
+# such that they run on a PC for benchmarks:
+#
+# uos          maps the device file system to the directory ROOT
+# time, gc     Micropython extensions like ticks_ms() and mem_free()
+# micropython  const(), and schedule() with a queue run by poll()
+# network      WLAN interfaces with the address 127.0.0.1
+# socket       sockets with readinto() and a selector based emulation of
+#              the _SO_REGISTER_HANDLER callbacks. Ports below 1024 are
+#              moved by LOW_PORT_OFFSET, e.g. 21 to 20021.
+#
+# load(name, path) runs a server file with these modules, and run_loop()
+# calls the registered handlers and scheduled functions.
+#
+# Distributed under MIT License
+#
+import os
+import sys
+import time as _time
+import gc as _gc
+import socket as _socket
+import selectors
+import threading
+import traceback
+import types
+
+ROOT = "/tmp"  # the directory which is / of the device
+LOW_PORT_OFFSET = 20000
+MEM_FREE = 200000  # reported by gc.mem_free()
+
+_SO_REGISTER_HANDLER = 20
+_selector = selectors.DefaultSelector()
+_lock = threading.RLock()
+_scheduled = []
+
+
+def device_path(path):
+    if not path.startswith("/"):
+        path = "/" + path
+    return ROOT + path
+
+
+def device_open(path, mode="r", *args, **kwargs):
+    return open(device_path(path), mode, *args, **kwargs)
+
+
+# uos
+
+uos = types.ModuleType("uos")
+uos.sep = "/"
+
+
+def _ilistdir(path="/"):
+    entries = os.scandir(device_path(path))  # raises now, as on the device
+    return ((entry.name, 0x4000 if entry.is_dir() else 0x8000, 0,
+             0 if entry.is_dir() else entry.stat().st_size)
+            for entry in entries)
+
+
+uos.ilistdir = _ilistdir
+uos.listdir = lambda path="/": os.listdir(device_path(path))
+uos.stat = lambda path: tuple(int(x) for x in
+                              tuple(os.stat(device_path(path)))[0:10])
+uos.remove = lambda path: os.remove(device_path(path))
+uos.rename = lambda old, new: os.rename(device_path(old), device_path(new))
+uos.mkdir = lambda path: os.mkdir(device_path(path))
+uos.rmdir = lambda path: os.rmdir(device_path(path))
+uos.statvfs = lambda path: tuple(os.statvfs(device_path(path)))[0:10]
+
+# time
+
+utime = types.ModuleType("time")
+utime.sleep = _time.sleep
+utime.sleep_ms = lambda ms: _time.sleep(ms / 1000)
+utime.ticks_ms = lambda: int(_time.monotonic() * 1000) & 0x3fffffff
+utime.ticks_us = lambda: int(_time.monotonic() * 1000000) & 0x3fffffff
+utime.ticks_diff = lambda a, b: (((a - b + 0x20000000) & 0x3fffffff) -
+                                 0x20000000)
+utime.ticks_add = lambda a, b: (a + b) & 0x3fffffff
+utime.localtime = lambda secs=None: tuple(_time.localtime(secs))[0:8]
+utime.time = lambda: int(_time.time())
+
+# gc
+
+ugc = types.ModuleType("gc")
+ugc.collect = _gc.collect
+ugc.mem_free = lambda: MEM_FREE
+ugc.mem_alloc = lambda: 100000
+ugc.threshold = lambda *args: -1
+
+# micropython
+
+micropython = types.ModuleType("micropython")
+micropython.const = lambda x: x
+micropython.alloc_emergency_exception_buf = lambda size: None
+
+
+def _schedule(func, arg):
+    with _lock:
+        if len(_scheduled) >= 8:  # the size of Micropython's queue
+            raise RuntimeError("schedule queue full")
+        _scheduled.append((func, arg))
+
+
+micropython.schedule = _schedule
+
+# network
+
+network = types.ModuleType("network")
+network.STA_IF = 0
+network.AP_IF = 1
+
+
+class WLAN:
+
+    def __init__(self, interface=0):
+        self.interface = interface
+
+    def active(self, *args):
+        return self.interface == network.STA_IF
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+
+network.WLAN = WLAN
+
+# socket
+
+usocket = types.ModuleType("socket")
+for _name in ("AF_INET", "SOCK_STREAM", "SOL_SOCKET", "SO_REUSEADDR",
+              "getaddrinfo"):
+    setattr(usocket, _name, getattr(_socket, _name))
+
+
+class socket:
+
+    def __init__(self, family=_socket.AF_INET, kind=_socket.SOCK_STREAM,
+                 sock=None):
+        self.sock = sock if sock is not None else _socket.socket(family, kind)
+        self.rbuf = b""  # read ahead by readline()
+        self.handler = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setsockopt(self, level, option, value):
+        if option != _SO_REGISTER_HANDLER:
+            self.sock.setsockopt(level, option, value)
+            return
+        with _lock:
+            if self.handler is not None:
+                _selector.unregister(self.sock)
+            self.handler = value
+            if value is not None:
+                _selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def bind(self, addr):
+        port = addr[1] + LOW_PORT_OFFSET if addr[1] < 1024 else addr[1]
+        self.sock.bind((addr[0], port))
+
+    def listen(self, backlog=1):
+        self.sock.listen(backlog)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    # Nagle's algorithm would delay the short replies by the delayed
+    # ACKs of the PC, which hides the time taken by the servers
+    def accept(self):
+        sock, addr = self.sock.accept()
+        sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+        return socket(sock=sock), addr
+
+    def connect(self, addr):
+        self.sock.connect(addr)
+        self.sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.sock.gettimeout() == 0:
+            try:
+                return self.sock.send(data)
+            except BlockingIOError:
+                return None
+        self.sock.sendall(data)
+        return len(data)
+
+    send = write
+
+    def sendall(self, data):
+        self.sock.sendall(data.encode() if isinstance(data, str) else data)
+
+    def recv(self, size):
+        if self.rbuf:
+            data, self.rbuf = self.rbuf[0:size], self.rbuf[size:]
+            return data
+        return self.sock.recv(size)
+
+    def readinto(self, buf, size=None):
+        mv = memoryview(buf).cast("B")
+        if size is not None:
+            mv = mv[0:size]
+        done = 0
+        while done < len(mv):  # blocking sockets fill buf, as on the device
+            try:
+                data = self.recv(len(mv) - done)
+            except BlockingIOError:
+                return done if done else None
+            if not data:
+                break
+            mv[done:done + len(data)] = data
+            done += len(data)
+        return done
+
+    def read(self, size=-1):
+        data = bytearray()
+        while size < 0 or len(data) < size:
+            try:
+                chunk = self.recv(4096 if size < 0 else size - len(data))
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def readline(self):
+        while b"\n" not in self.rbuf:
+            data = self.sock.recv(512)
+            if not data:
+                break
+            self.rbuf += data
+        end = self.rbuf.find(b"\n") + 1 or len(self.rbuf)
+        line, self.rbuf = self.rbuf[0:end], self.rbuf[end:]
+        return line
+
+    def close(self):
+        with _lock:
+            if self.handler is not None:
+                _selector.unregister(self.sock)
+                self.handler = None
+        self.sock.close()
+
+
+usocket.socket = socket
+
+
+def print_exception(exc, file=sys.stdout):
+    traceback.print_exception(type(exc), exc, exc.__traceback__, file=file)
+
+
+MODULES = {"uos": uos, "os": uos, "time": utime, "utime": utime, "gc": ugc,
+           "micropython": micropython, "network": network,
+           "socket": usocket, "usocket": usocket}
+
+
+# run the server file at path as module name with the stand-in modules.
+# They stay installed, since the servers import some of them late.
+def load(name, path):
+    sys.modules.update(MODULES)
+    sys.print_exception = print_exception
+    module = types.ModuleType(name)
+    module.__file__ = path
+    module.const = micropython.const
+    module.open = device_open
+    sys.modules[name] = module
+    with open(path) as file:
+        exec(compile(file.read(), path, "exec"), module.__dict__)
+    return module
+
+
+# call the handlers of readable sockets and the scheduled functions once
+def poll(timeout=0.02):
+    with _lock:
+        registered = bool(_selector.get_map())
+        events = (_selector.select(0 if _scheduled else timeout)
+                  if registered else [])
+    if not registered:
+        _time.sleep(timeout)
+    for key, mask in events:
+        sock = key.data
+        if sock.handler is not None:
+            try:
+                sock.handler(sock)
+            except Exception:
+                traceback.print_exc()
+    with _lock:
+        todo = _scheduled[:]
+        del _scheduled[:]
+    for func, arg in todo:
+        try:
+            func(arg)
+        except Exception:
+            traceback.print_exc()
+
+
+def run_loop():
+    while True:
+        poll()
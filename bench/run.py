@@ -0,0 +1,218 @@
+#
+# Benchmark of the ftp servers on a PC
+#
+# Each server runs in a child process under CPython with the stand-in
+# modules of mpshim.py, serving a temporary directory on port 20021.
+# Scripted clients measure over loopback:
+#
+# rtt      round trip time of NOOP on the command connection
+# stor     upload throughput
+# retr     download throughput
+# list     LIST and NLST time of directories with 10, 100 and 1000 files
+#
+# python3 bench/run.py [-s uftpd,ftp,ftp_thread] [-o results.json]
+#                      [--size bytes] [--repeat count] [-c old.json]
+#
+# The results are printed or written as JSON. With -c, they are compared
+# to those of an earlier run, e.g. one of the previous commit.
+#
+# Distributed under MIT License
+#
+import argparse
+import ftplib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mpshim
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = ("uftpd", "ftp", "ftp_thread")
+PORT = 21 + mpshim.LOW_PORT_OFFSET
+LIST_SIZES = (10, 100, 1000)
+
+
+# run server name with root as / of the device; called in the child
+def serve(name, root):
+    mpshim.ROOT = root
+    module = mpshim.load(name, os.path.join(REPO, name + ".py"))
+    if name == "uftpd":  # started on import, runs by the handlers
+        mpshim.run_loop()
+    elif name == "ftp":  # returns after each session
+        while True:
+            module.ftpserver()
+    else:  # ftp_thread runs in a thread started on import
+        while True:
+            time.sleep(1)
+
+
+def connect(timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            ftp = ftplib.FTP()
+            ftp.connect("127.0.0.1", PORT, timeout=30)
+            ftp.login()
+            return ftp
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def bench_rtt(ftp, count):
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        ftp.voidcmd("NOOP")
+        times.append(time.perf_counter() - start)
+    return {"median_ms": round(median(times) * 1000, 3),
+            "mean_ms": round(sum(times) / count * 1000, 3)}
+
+
+def bench_transfer(ftp, size, repeat):
+    data = os.urandom(size)
+    stor, retr = [], []
+    ftp.voidcmd("TYPE I")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ftp.storbinary("STOR /bench.bin", io.BytesIO(data))
+        stor.append(time.perf_counter() - start)
+        received = io.BytesIO()
+        start = time.perf_counter()
+        ftp.retrbinary("RETR /bench.bin", received.write)
+        retr.append(time.perf_counter() - start)
+        if received.getvalue() != data:
+            raise ValueError("RETR returned other data than stored")
+    ftp.delete("/bench.bin")
+    result = {}
+    for name, times in (("stor", stor), ("retr", retr)):
+        result[name] = {"median_kbps": round(size / median(times) / 1000, 1),
+                        "best_kbps": round(size / min(times) / 1000, 1)}
+    return result
+
+
+# the first listing is cold, the following ones may come from a cache
+def bench_list(ftp, root, repeat):
+    result = {}
+    for count in LIST_SIZES:
+        path = "/list{}".format(count)
+        os.mkdir(root + path)
+        for i in range(count):
+            with open("{}{}/file{:04d}.txt".format(root, path, i), "w") as f:
+                f.write("x" * i)
+        for command in ("LIST", "NLST"):
+            times = []
+            for _ in range(repeat + 1):
+                lines = []
+                start = time.perf_counter()
+                ftp.retrlines("{} {}".format(command, path), lines.append)
+                times.append(time.perf_counter() - start)
+                if len(lines) != count:
+                    raise ValueError("{} {} returned {} lines".format(
+                        command, path, len(lines)))
+            result["{}_{}".format(command.lower(), count)] = {
+                "cold_ms": round(times[0] * 1000, 3),
+                "warm_ms": round(median(times[1:]) * 1000, 3)}
+    return result
+
+
+def bench_server(name, args):
+    root = tempfile.mkdtemp(prefix="bench_")
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", name, root],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ftp = connect()
+        result = {"rtt": bench_rtt(ftp, args.rtt)}
+        result.update(bench_transfer(ftp, args.size, args.repeat))
+        result["list"] = bench_list(ftp, root, args.repeat)
+        ftp.quit()
+    except Exception as err:
+        result = {"error": repr(err)}
+    finally:
+        child.kill()
+        child.wait()
+        shutil.rmtree(root, ignore_errors=True)
+    return result
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "-C", REPO, "describe", "--always", "--dirty"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# the numbers of a result as {"server.section.key": value}
+def flatten(result, prefix=""):
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)):
+            values[prefix + key] = value
+    return values
+
+
+def compare(old, new):
+    old_values = flatten(old["servers"])
+    for key, value in sorted(flatten(new["servers"]).items()):
+        if key in old_values and old_values[key]:
+            print("{:40} {:>12} {:>12} {:>+8.1f}%".format(
+                key, old_values[key], value,
+                (value - old_values[key]) * 100 / old_values[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ftp server benchmark")
+    parser.add_argument("-s", "--servers", default=",".join(SERVERS),
+                        help="comma separated list of " + ", ".join(SERVERS))
+    parser.add_argument("-o", "--output", help="JSON file of the results")
+    parser.add_argument("-c", "--compare", help="JSON file of an earlier run")
+    parser.add_argument("--size", type=int, default=1 << 20,
+                        help="file size of RETR and STOR")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rtt", type=int, default=200,
+                        help="number of NOOP round trips")
+    parser.add_argument("--serve", nargs=2, metavar=("SERVER", "ROOT"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(*args.serve)
+        return
+
+    results = {"commit": commit(),
+               "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": sys.version.split()[0],
+               "size": args.size,
+               "servers": {}}
+    for name in args.servers.split(","):
+        if name not in SERVERS:
+            parser.error("unknown server " + name)
+        results["servers"][name] = bench_server(name, args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
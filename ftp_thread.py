@@ -18,29 +18,79 @@ import socket
 import network
 import uos
 import gc
+from time import localtime
+from micropython import const
+
+_LIST_SORT = const(100)  # larger directories are listed unsorted
+_GC_FREE = const(8192)  # collect garbage if less heap is free
+_ACCEPT_TIMEOUT = const(10)  # s to wait for a passive data connection
+
+# fixed replies, encoded once such that sending them does not allocate
+msg_150_list = b"150 Here comes the directory listing.\r\n"
+msg_150_retr = b"150 Opening data connection.\r\n"
+msg_150_stor = b"150 Ok to send data.\r\n"
+msg_200_OK = b"200 OK\r\n"
+msg_200_type = b"200 Transfer mode set\r\n"
+msg_211_feat = b"211-Features:\r\n SIZE\r\n REST STREAM\r\n211 End\r\n"
+msg_213_list = b"213-Directory listing:\r\n"
+msg_213_done = b"213 Done.\r\n"
+msg_215_syst = b"215 UNIX Type: L8\r\n"
+msg_220_hello = b"220 Hello, this is the ESP8266/ESP32.\r\n"
+msg_221_bye = b"221 Bye.\r\n"
+msg_226_list = b"226 Listed.\r\n"
+msg_226_done = b"226 Transfer complete.\r\n"
+msg_230_login = b"230 Logged in.\r\n"
+msg_250_OK = b"250 OK\r\n"
+msg_350_rename = b"350 Rename from\r\n"
+msg_501_offset = b"501 Bad offset.\r\n"
+msg_502_unsupported = b"502 Unsupported command.\r\n"
+msg_504_fail = b"504 Fail\r\n"
+msg_550_fail = b"550 Failed\r\n"
+reply_buf = bytearray(80)  # numeric replies are formatted here
+reply_mv = memoryview(reply_buf)
 
 
 def send_list_data(path, dataclient, full):
+    pattern = None
     try:  # whether path is a directory name
-        for fname in sorted(uos.listdir(path), key=str.lower):
-            dataclient.sendall(make_description(path, fname, full))
+        entries = uos.ilistdir(path)
     except:  # path may be a file name or pattern
         pattern = path.split("/")[-1]
         path = path[:-(len(pattern) + 1)]
         if path == "":
             path = "/"
-        for fname in sorted(uos.listdir(path), key=str.lower):
-            if fncmp(fname, pattern):
-                dataclient.sendall(make_description(path, fname, full))
+        pattern = compile_pattern(pattern)
+        entries = uos.ilistdir(path)
+    for entry in sort_entries(entries, _LIST_SORT):
+        if pattern is None or fncmp(entry[0], pattern):
+            dataclient.sendall(make_description(path, entry, full))
+
+
+# sort entries by name, if there are not more than limit of them.
+# Larger directories are listed in the order of the file system.
+def sort_entries(entries, limit):
+    head = []
+    for entry in entries:
+        head.append(entry)
+        if len(head) > limit:
+            yield from head
+            yield from entries
+            return
+    head.sort(key=lambda entry: entry[0].lower())
+    yield from head
 
 
-def make_description(path, fname, full):
+def make_description(path, entry, full):
+    fname = entry[0]
     if full:
-        stat = uos.stat(get_absolute_path(path, fname))
+        if len(entry) > 3:  # type and size are told by ilistdir()
+            file_mode, file_size = entry[1], entry[3]
+        else:
+            stat = uos.stat(get_absolute_path(path, fname))
+            file_mode, file_size = stat[0], stat[6]
         file_permissions = "drwxr-xr-x"\
-            if (stat[0] & 0o170000 == 0o040000)\
+            if (file_mode & 0o170000 == 0o040000)\
             else "-rw-r--r--"
-        file_size = stat[6]
         description = "{}    1 owner group {:>10} Jan 1 2000 {}\r\n".format(
                 file_permissions, file_size, fname)
     else:
@@ -48,20 +98,38 @@ def make_description(path, fname, full):
     return description
 
 
-def send_file_data(path, dataclient):
+def send_file_data(path, dataclient, offset=0):
+    buffer = alloc_buffer()
+    mv = memoryview(buffer)
     with open(path, "rb") as file:
-        chunk = file.read(512)
-        while len(chunk) > 0:
-            dataclient.sendall(chunk)
-            chunk = file.read(512)
+        if offset > 0:
+            file.seek(offset)
+        bytes_read = file.readinto(buffer)
+        while bytes_read > 0:
+            dataclient.write(mv[0:bytes_read])
+            bytes_read = file.readinto(buffer)
 
 
-def save_file_data(path, dataclient):
-    with open(path, "wb") as file:
-        chunk = dataclient.recv(512)
-        while len(chunk) > 0:
-            file.write(chunk)
-            chunk = dataclient.recv(512)
+def save_file_data(path, dataclient, offset=0):
+    buffer = alloc_buffer()
+    mv = memoryview(buffer)
+    if offset > 0 and offset > uos.stat(path)[6]:
+        raise OSError(22)  # EINVAL, beyond the end of the file
+    with open(path, "r+b" if offset > 0 else "wb") as file:
+        if offset > 0:  # resume, keeping what is before offset
+            file.seek(offset)
+        bytes_read = dataclient.readinto(buffer)
+        while bytes_read > 0:
+            file.write(mv[0:bytes_read])
+            bytes_read = dataclient.readinto(buffer)
+
+
+# transfer buffer of 512 to 4096 bytes, as large as the free heap allows
+def alloc_buffer():
+    size = 4096
+    while size > 512 and size * 16 > gc.mem_free():
+        size //= 2
+    return bytearray(size)
 
 
 def get_absolute_path(cwd, payload):
@@ -84,31 +152,106 @@ def get_absolute_path(cwd, payload):
     return cwd
 
 
-# compare fname against pattern. Pattern may contain
-# wildcards ? and *.
+# compile a pattern for fncmp(). Pattern may contain the wildcards ? and *
+# and character classes like [abc], [a-z] or [!abc]. The result is a tuple
+# with one entry per pattern position: "" for *, None for ?, a string
+# of the matching characters, or a 1-tuple of the characters not matching.
+def compile_pattern(pattern):
+    tokens = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if not tokens or tokens[-1] != "":  # ** is the same as *
+                tokens.append("")
+        elif c == "?":
+            tokens.append(None)
+        elif c == "[":
+            start = i + 1 if pattern[i:i + 1] in ("!", "^") else i
+            end = pattern.find("]", start + 1)  # a leading ] is a member
+            if end < 0:  # no class, but a plain [
+                tokens.append(c)
+                continue
+            chars = ""
+            j = start
+            while j < end:
+                if j + 2 < end and pattern[j + 1] == "-":  # range
+                    for k in range(ord(pattern[j]), ord(pattern[j + 2]) + 1):
+                        chars += chr(k)
+                    j += 3
+                else:
+                    chars += pattern[j]
+                    j += 1
+            tokens.append((chars,) if start > i else chars)
+            i = end + 1
+        else:
+            tokens.append(c)
+    return tuple(tokens)
+
+
+# compare fname against a compiled pattern. The matching is iterative,
+# going back to the last * on a mismatch, and does not slice fname.
 def fncmp(fname, pattern):
+    if type(pattern) is str:
+        pattern = compile_pattern(pattern)
     pi = 0
     si = 0
-    while pi < len(pattern) and si < len(fname):
-        if (fname[si] == pattern[pi]) or (pattern[pi] == '?'):
-            si += 1
-            pi += 1
-        else:
-            if pattern[pi] == '*':  # recurse
-                if (pi + 1) == len(pattern):
-                    return True
-                while si < len(fname):
-                    if fncmp(fname[si:], pattern[pi+1:]):
-                        return True
-                    else:
-                        si += 1
-                return False
-            else:
-                return False
-    if pi == len(pattern.rstrip("*")) and si == len(fname):
-        return True
-    else:
-        return False
+    star = -1  # position of the last * in pattern
+    mark = 0  # position in fname where that * continues
+    while si < len(fname):
+        if pi < len(pattern):
+            token = pattern[pi]
+            if token == "":
+                star = pi
+                mark = si
+                pi += 1
+                continue
+            if (token is None or
+                    (fname[si] in token if type(token) is str
+                     else fname[si] not in token[0])):
+                pi += 1
+                si += 1
+                continue
+        if star < 0:
+            return False
+        pi = star + 1
+        mark += 1
+        si = mark
+    while pi < len(pattern) and pattern[pi] == "":
+        pi += 1
+    return pi == len(pattern)
+
+
+# accept the passive data connection, once the transfer is requested,
+# such that PASV does not wait for the client
+def accept_data(datasocket):
+    dataclient, data_addr = datasocket.accept()
+    print("FTP Data connection from:", data_addr)
+    return dataclient
+
+
+# send head, the numbers with at least width decimal digits each and sep
+# between them, and tail as one reply, which is formatted in reply_buf
+def send_numbers(cl, head, numbers, tail=b"\r\n", width=1, sep=b""):
+    pos = len(head)
+    reply_buf[0:pos] = head
+    for value in numbers:
+        if sep and pos > len(head):
+            reply_buf[pos:pos + len(sep)] = sep
+            pos += len(sep)
+        digits = 1
+        rest = value
+        while rest >= 10:
+            rest //= 10
+            digits += 1
+        end = pos + max(digits, width)
+        for i in range(end - 1, pos - 1, -1):
+            reply_buf[i] = 0x30 + value % 10
+            value //= 10
+        pos = end
+    reply_buf[pos:pos + len(tail)] = tail
+    cl.sendall(reply_mv[0:pos + len(tail)])
 
 
 def ftpserver(not_stop_on_quit):
@@ -127,10 +270,8 @@ def ftpserver(not_stop_on_quit):
     ftpsocket.listen(1)
     ftpsocket.settimeout(None)
     datasocket.listen(1)
-    datasocket.settimeout(None)
+    datasocket.settimeout(_ACCEPT_TIMEOUT)
 
-    msg_250_OK = '250 OK\r\n'
-    msg_550_fail = '550 Failed\r\n'
     # check for an active interface, STA first
     wlan = network.WLAN(network.STA_IF)
     if wlan.active():
@@ -143,6 +284,8 @@ def ftpserver(not_stop_on_quit):
             print("No active connection")
             return
 
+    pasv_reply = "227 Entering Passive Mode ({},".format(
+        addr.replace('.', ',')).encode()  # the port follows
     print("FTP Server started on ", addr)
     try:
         dataclient = None
@@ -152,11 +295,12 @@ def ftpserver(not_stop_on_quit):
             cl, remote_addr = ftpsocket.accept()
             cl.settimeout(300)
             cwd = '/'
+            restart = 0  # offset set by REST for the next RETR or STOR
+            active = True  # False after PASV
             try:
                 # print("FTP connection from:", remote_addr)
-                cl.sendall("220 Hello, this is the ESP8266/ESP32.\r\n")
+                cl.sendall(msg_220_hello)
                 while True:
-                    gc.collect()
                     data = cl.readline().decode("utf-8").rstrip("\r\n")
                     if len(data) <= 0:
                         print("Client disappeared")
@@ -165,19 +309,23 @@ def ftpserver(not_stop_on_quit):
 
                     command = data.split(" ")[0].upper()
                     payload = data[len(command):].lstrip()
+                    # collect only before commands which allocate much
+                    if (gc.mem_free() < _GC_FREE or
+                            command in ("LIST", "NLST", "RETR", "STOR")):
+                        gc.collect()
 
                     path = get_absolute_path(cwd, payload)
 
                     print("Command={}, Payload={}".format(command, payload))
 
                     if command == "USER":
-                        cl.sendall("230 Logged in.\r\n")
+                        cl.sendall(msg_230_login)
                     elif command == "SYST":
-                        cl.sendall("215 UNIX Type: L8\r\n")
+                        cl.sendall(msg_215_syst)
                     elif command == "NOOP":
-                        cl.sendall("200 OK\r\n")
+                        cl.sendall(msg_200_OK)
                     elif command == "FEAT":
-                        cl.sendall("211 no-features\r\n")
+                        cl.sendall(msg_211_feat)
                     elif command == "PWD" or command == "XPWD":
                         cl.sendall('257 "{}"\r\n'.format(cwd))
                     elif command == "CWD" or command == "XCWD":
@@ -192,22 +340,21 @@ def ftpserver(not_stop_on_quit):
                         cl.sendall(msg_250_OK)
                     elif command == "TYPE":
                         # probably should switch between binary and not
-                        cl.sendall('200 Transfer mode set\r\n')
+                        cl.sendall(msg_200_type)
                     elif command == "SIZE":
                         try:
                             size = uos.stat(path)[6]
-                            cl.sendall('213 {}\r\n'.format(size))
+                            send_numbers(cl, b"213 ", (size,))
                         except:
                             cl.sendall(msg_550_fail)
                     elif command == "QUIT":
-                        cl.sendall('221 Bye.\r\n')
+                        cl.sendall(msg_221_bye)
                         do_run = not_stop_on_quit
                         break
                     elif command == "PASV":
-                        cl.sendall('227 Entering Passive Mode ({},{},{}).\r\n'.format(
-                            addr.replace('.', ','), DATA_PORT >> 8, DATA_PORT % 256))
-                        dataclient, data_addr = datasocket.accept()
-                        print("FTP Data connection from:", data_addr)
+                        send_numbers(cl, pasv_reply,
+                                     (DATA_PORT >> 8, DATA_PORT % 256),
+                                     b").\r\n", sep=b",")
                         DATA_PORT = 13333
                         active = False
                     elif command == "PORT":
@@ -223,43 +370,60 @@ def ftpserver(not_stop_on_quit):
                             dataclient.settimeout(10)
                             dataclient.connect((data_addr, DATA_PORT))
                             print("FTP Data connection with:", data_addr)
-                            cl.sendall('200 OK\r\n')
+                            cl.sendall(msg_200_OK)
                             active = True
                         else:
-                            cl.sendall('504 Fail\r\n')
+                            cl.sendall(msg_504_fail)
                     elif command == "LIST" or command == "NLST":
                         if not payload.startswith("-"):
                             place = path
                         else:
                             place = cwd
                         try:
-                            cl.sendall("150 Here comes the "
-                                       "directory listing.\r\n")
+                            if dataclient is None and not active:
+                                dataclient = accept_data(datasocket)
+                            cl.sendall(msg_150_list)
                             send_list_data(place, dataclient,
                                            command == "LIST" or payload == "-l")
-                            cl.sendall("226 Listed.\r\n")
+                            cl.sendall(msg_226_list)
                         except:
                             cl.sendall(msg_550_fail)
                         if dataclient is not None:
                             dataclient.close()
                             dataclient = None
+                    elif command == "REST":
+                        try:
+                            restart = int(payload)
+                            if restart < 0:
+                                raise ValueError
+                            send_numbers(cl, b"350 Restarting at ", (restart,),
+                                         b".\r\n")
+                        except:
+                            restart = 0
+                            cl.sendall(msg_501_offset)
                     elif command == "RETR":
                         try:
-                            cl.sendall("150 Opening data connection.\r\n")
-                            send_file_data(path, dataclient)
-                            cl.sendall("226 Transfer complete.\r\n")
+                            if dataclient is None and not active:
+                                dataclient = accept_data(datasocket)
+                            cl.sendall(msg_150_retr)
+                            send_file_data(path, dataclient, restart)
+                            cl.sendall(msg_226_done)
                         except:
                             cl.sendall(msg_550_fail)
+                        restart = 0
                         if dataclient is not None:
                             dataclient.close()
                             dataclient = None
                     elif command == "STOR":
                         try:
-                            cl.sendall("150 Ok to send data.\r\n")
-                            save_file_data(path, dataclient)
-                            cl.sendall("226 Transfer complete.\r\n")
+                            if dataclient is None and not active:
+                                dataclient = accept_data(datasocket)
+                            cl.sendall(msg_150_stor)
+                            save_file_data(path, dataclient, restart)
+                            cl.sendall(msg_226_done)
                         except:
                             cl.sendall(msg_550_fail)
+                        restart = 0
                         if dataclient is not None:
                             dataclient.close()
                             dataclient = None
@@ -283,7 +447,7 @@ def ftpserver(not_stop_on_quit):
                             cl.sendall(msg_550_fail)
                     elif command == "RNFR":
                             fromname = path
-                            cl.sendall("350 Rename from\r\n")
+                            cl.sendall(msg_350_rename)
                     elif command == "RNTO":
                             if fromname is not None:
                                 try:
@@ -296,10 +460,10 @@ def ftpserver(not_stop_on_quit):
                             fromname = None
                     elif command == "MDTM":
                         try:
-                            tm=localtime(uos.stat(path)[8])
-                            cl.sendall('213 {:04d}{:02d}{:02d}{:02d}{:02d}{:02d}\r\n'.format(*tm[0:6]))
+                            tm = localtime(uos.stat(path)[8])
+                            send_numbers(cl, b"213 ", tm[0:6], width=2)
                         except:
-                            cl.sendall('550 Fail\r\n')
+                            cl.sendall(msg_550_fail)
                     elif command == "STAT":
                         if payload == "":
                             cl.sendall("211-Connected to ({})\r\n"
@@ -308,11 +472,11 @@ def ftpserver(not_stop_on_quit):
                                        "MODE: Stream\r\n".format(
                                         remote_addr[0], addr))
                         else:
-                            cl.sendall("213-Directory listing:\r\n")
+                            cl.sendall(msg_213_list)
                             send_list_data(path, cl, True)
-                            cl.sendall("213 Done.\r\n")
+                            cl.sendall(msg_213_done)
                     else:
-                        cl.sendall("502 Unsupported command.\r\n")
+                        cl.sendall(msg_502_unsupported)
                         print("Unsupported command {} with payload {}".
                               format(command, payload))
             except Exception as err:
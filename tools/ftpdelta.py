@@ -0,0 +1,152 @@
+#
+# Delta upload of a file to uftpd, for a PC with CPython
+#
+# The block checksums of the file on the device are fetched with
+# SITE SUMS. The blocks which the local file has too, anywhere, are
+# found with the rolling weak checksum of rsync, and only the other
+# data is sent with SITE DELTA. Without the file on the device, the
+# whole file is sent with STOR.
+#
+# python3 tools/ftpdelta.py [-P port] [-u user] [-p password]
+#                           [-b blocksize] host localfile remotefile
+#
+# Distributed under MIT License
+#
+import argparse
+import ftplib
+import hashlib
+import io
+import struct
+import zlib
+
+BLOCK = 1024
+
+
+class Crc32:
+
+    def __init__(self, data=b""):
+        self.value = zlib.crc32(data)
+
+    def digest(self):
+        return struct.pack(">I", self.value & 0xffffffff)
+
+
+HASHES = {"SHA-256": hashlib.sha256, "SHA-1": hashlib.sha1,
+          "MD5": hashlib.md5, "CRC32": Crc32}
+
+
+# the block checksums of the file remote as (algorithm, block size,
+# file size, {weak: [(index, hash), ...]})
+def block_sums(ftp, remote, block=BLOCK):
+    lines = []
+    ftp.retrlines("SITE SUMS {} {}".format(block, remote), lines.append)
+    name, block, size = lines[0].split()
+    sums = {}
+    for line in lines[1:]:
+        index, weak, strong = line.split()
+        sums.setdefault(int(weak, 16), []).append((int(index),
+                                                   bytes.fromhex(strong)))
+    return name, int(block), int(size), sums
+
+
+# the block of sums with the weak checksum and the hash of data, or None
+def find_block(sums, weak, data, algo):
+    candidates = sums.get(weak)
+    if candidates:
+        strong = HASHES[algo](data).digest()
+        for index, value in candidates:
+            if value == strong:
+                return index
+    return None
+
+
+def weak_sum(data):
+    a = b = 0
+    for byte in data:
+        a = (a + byte) & 0xffff
+        b = (b + a) & 0xffff
+    return a, b
+
+
+# the delta stream which makes data from the remote file of the sums
+def make_delta(data, algo, block, size, sums):
+    records = []
+    copy = None  # [index, count] of the pending "C" record
+    literal = 0  # start of the literal data not yet in records
+
+    def flush(end):
+        nonlocal copy
+        if copy is not None:  # the copied blocks are before literal
+            records.append(b"C" + struct.pack(">II", *copy))
+            copy = None
+        if end > literal:
+            records.append(b"L" + struct.pack(">I", end - literal))
+            records.append(data[literal:end])
+
+    pos = 0
+    a, b = weak_sum(data[0:block])
+    while pos + block <= len(data):
+        index = find_block(sums, b << 16 | a, data[pos:pos + block], algo)
+        if index is not None:
+            if copy is not None and copy[0] + copy[1] == index and \
+                    pos == literal:
+                copy[1] += 1
+            else:
+                flush(pos)
+                copy = [index, 1]
+            pos += block
+            literal = pos
+            a, b = weak_sum(data[pos:pos + block])
+            continue
+        if pos + block < len(data):  # roll the window by one byte
+            out, new = data[pos], data[pos + block]
+            a = (a - out + new) & 0xffff
+            b = (b - block * out + a) & 0xffff
+        pos += 1
+    # the short last block of the remote file may end data too
+    tail = size % block
+    if tail and len(data) - literal >= tail:
+        end = data[len(data) - tail:]
+        a, b = weak_sum(end)
+        index = find_block(sums, b << 16 | a, end, algo)
+        if index == size // block:
+            flush(len(data) - tail)
+            records.append(b"C" + struct.pack(">II", index, 1))
+            literal = len(data)
+    flush(len(data))
+    return b"".join(records)
+
+
+# upload the file local as remote, and return the reply of the server
+def put_delta(ftp, local, remote, block=BLOCK):
+    with open(local, "rb") as file:
+        data = file.read()
+    ftp.voidcmd("TYPE I")
+    try:
+        algo, block, size, sums = block_sums(ftp, remote, block)
+    except ftplib.error_perm:  # no such file yet
+        return ftp.storbinary("STOR " + remote, io.BytesIO(data))
+    delta = make_delta(data, algo, block, size, sums)
+    return ftp.storbinary("SITE DELTA {} {}".format(block, remote),
+                          io.BytesIO(delta))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="delta upload to uftpd")
+    parser.add_argument("host")
+    parser.add_argument("local")
+    parser.add_argument("remote")
+    parser.add_argument("-P", "--port", type=int, default=21)
+    parser.add_argument("-u", "--user", default="anonymous")
+    parser.add_argument("-p", "--password", default="")
+    parser.add_argument("-b", "--block", type=int, default=BLOCK)
+    args = parser.parse_args()
+    ftp = ftplib.FTP()
+    ftp.connect(args.host, args.port)
+    ftp.login(args.user, args.password)
+    print(put_delta(ftp, args.local, args.remote, args.block))
+    ftp.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,46 @@
 # Based on the work of chrisgp - Christopher Popp and pfalcon - Paul Sokolovsky
 #
 # The server accepts passive mode only. It runs in background.
+# Data transfers are split into chunks, and the chunks of all active
+# transfers are moved round robin by a scheduled task, such that a long
+# transfer does not block the other sessions.
 # Start the server with:
 #
 # import uftpd
-# uftpd.start([port = 21][, verbose = level])
+# uftpd.start([port = 21][, verbose = level][, data_port = 13333]
+#             [, data_ports = 4][, chunk_min = 512][, chunk_max = 16384]
+#             [, buffers = 2][, cache_size = 64][, cache_ttl = 5000]
+#             [, list_sort = 0][, write_size = 4096][, gc_free = 8192]
+#             [, hash_index = "/.hashindex"])
 #
 # port is the port number (default 21)
 # verbose controls the level of printed activity messages, values 0, 1, 2
+# chunk_min and chunk_max are the bounds of the transfer chunk size. It is
+# chosen from the free heap and adapted per transfer to the throughput.
+# buffers is the number of transfer buffers allocated at start, which
+# limits the number of transfers running at the same time.
+# cache_size is the number of file stat results kept in a cache, and
+# cache_size // 8 the number of directory listings. Entries are dropped
+# when changed by the server, or after cache_ttl ms for changes made
+# otherwise. cache_size = 0 disables the cache.
+# list_sort is the largest number of directory entries, which are sorted
+# by name in listings. Larger directories are listed unsorted.
+# write_size is the size of the blocks, in which uploads are written to
+# the file, aligned to the file position. It should be the sector size of
+# the flash, and is limited by the buffer size. 0 writes the data as
+# received.
+# gc_free is the free heap, below which a command is preceded by a garbage
+# collection. Transfers, listings and SITE always collect before.
+# hash_index is the file, which keeps the hashes told by HASH, XMD5, XCRC
+# and XSHA256 with the size and mtime of the file. A hash is computed
+# again only if the file changed. "" keeps them in RAM only.
+# data_port is the first port of the passive data port pool, and data_ports
+# the number of ports in that pool. Each session gets one of these ports
+# on PASV and returns it after the transfer.
+#
+# uftpd.stats([reset]) returns the call count, total and maximal time of
+# each command and the transfer counters, which are told by STAT too.
+# reset = True clears them.
 #
 # Copyright (c) 2016 Christopher Popp (initial ftp server framework)
 # Copyright (c) 2016 Paul Sokolovsky (background execution control structure)
@@ -20,31 +53,580 @@
 # Distributed under MIT License
 #
 import socket
-import network
-import uos
 import gc
 import sys
 import errno
-from time import sleep_ms, localtime
-from micropython import alloc_emergency_exception_buf
+from time import localtime
+from array import array
+try:
+    import uos
+    from uos import ilistdir
+    from time import sleep_ms, ticks_ms, ticks_us, ticks_diff
+    from micropython import alloc_emergency_exception_buf, schedule
+    from gc import mem_free
+except ImportError:  # CPython, when used by uftpd_async
+    import os as uos
+    from time import sleep, monotonic
+
+    def const(x):
+        return x
+
+    def mem_free():
+        return 0x100000
+
+    def ilistdir(path):
+        entries = uos.scandir(path)
+        return ((entry.name, 0x4000 if entry.is_dir() else 0x8000,
+                 entry.inode()) for entry in entries)
+
+    def sleep_ms(ms):
+        sleep(ms / 1000)
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_us():
+        return int(monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+try:
+    import deflate  # MODE Z with Micropython
+    from io import BytesIO
+except ImportError:
+    deflate = None
+try:
+    from zlib import compressobj, decompressobj  # MODE Z with CPython
+except ImportError:
+    compressobj = None
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+try:
+    from binascii import hexlify, crc32
+except ImportError:
+    from binascii import hexlify
+    crc32 = None
 
 # constant definitions
-_CHUNK_SIZE = const(1024)
+_CHUNK_MIN = const(512)
+_CHUNK_MAX = const(16384)
+_CHUNK_HEAP_SHARE = const(16)  # a transfer buffer takes at most 1/16 of heap
+_BUFFERS = const(2)
+_CACHE_SIZE = const(64)
+_CACHE_TTL = const(5000)
+_CACHE_DIR_MAX = const(64)  # larger directory listings are not cached
+_WRITE_SIZE = const(4096)  # flash sector size
+_GC_FREE = const(8192)  # collect garbage if less heap is free
+# listing styles
+_NLST = const(0)  # names only
+_LIST = const(1)  # like ls -l
+_MLSD = const(2)  # facts of RFC 3659
+# counters of stat_counts
+_STAT_SENT = const(0)  # bytes sent by transfers and listings
+_STAT_RECEIVED = const(1)  # bytes received by transfers
+_STAT_TRANSFERS = const(2)  # transfers done
+_STAT_FAILED = const(3)  # transfers failed or aborted
+_STAT_DATA_FAIL = const(4)  # data connections which failed to open
+_STAT_BUSY = const(5)  # commands rejected, since another one was served
+_STAT_GC = const(6)  # garbage collections
+_STAT_GC_TIME = const(7)  # us taken by them
+_STAT_COUNTS = const(8)
+# flags of the command table
+_PATH = const(1)  # the handler gets the absolute path of the payload
+_LOGIN = const(2)  # the command needs a logged in session
+_GC = const(4)  # collect garbage before, since the command allocates
+_RATE_WINDOW = const(500)  # ms between throughput measurements
 _SO_REGISTER_HANDLER = const(20)
 _COMMAND_TIMEOUT = const(300)
 _DATA_TIMEOUT = const(100)
+_ACCEPT_TIMEOUT = const(10)  # s to wait for a passive data connection
 _DATA_PORT = const(13333)
+_DATA_PORTS = const(4)
+_ZLIB_WBITS = const(10)  # MODE Z sends with a window of 1 kByte
+_ZLIB_INPUT = const(512)  # receive buffer for compressed data
+_HASH_INDEX_MAX = const(128)  # entries of the hash index
+_TAR_BLOCK = const(512)
+_TAR_FAILS = const(16)  # failed members named in the reply of STOR x.tar
+_DELTA_BLOCK_MAX = const(65536)  # block size of SITE SUMS and SITE DELTA
 
 # Global variables
 ftpsockets = []
-datasocket = None
+datasockets = []  # all passive data sockets as (socket, port)
+free_datasockets = []  # the ones not leased to a session
 client_list = []
+transfer_list = []  # clients with a running data transfer
+transfer_scheduled = False
 verbose_l = 0
 client_busy = False
+chunk_min_l = _CHUNK_MIN
+chunk_max_l = _CHUNK_MAX
+list_sort_l = 0
+write_size_l = _WRITE_SIZE
+gc_free_l = _GC_FREE
+hash_index_l = "/.hashindex"  # file of the hash index, "" for none
+hash_entries = None  # the hash index, loaded on first use
+hash_lines = 0  # lines of the index file, some may be outdated
+buffer_pool = []  # free transfer buffers, as memoryview
 # Interfaces: (IP-Address (string), IP-Address (integer), Netmask (integer))
 
+# seconds from 1970 to the epoch of time.localtime(), for tar headers
+_epoch_offset = 946684800 if localtime(0)[0] == 2000 else 0
 _month_name = ("", "Jan", "Feb", "Mar", "Apr", "May", "Jun",
                "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+# LIST lines for files of another year and of this year
+_list_format_year = "{} 1 owner group {:>10} {} {:2} {:>5} {}\r\n"
+_list_format_time = "{} 1 owner group {:>10} {} {:2} {:02}:{:02} {}\r\n"
+
+
+# fixed replies, encoded once such that sending them does not allocate
+msg_150_list = b"150 Directory listing:\r\n"
+msg_150_open = b"150 Opened data connection.\r\n"
+msg_200_OK = b"200 OK\r\n"
+msg_211_feat = (b"211-Features:\r\n MDTM\r\n SIZE\r\n REST STREAM\r\n"
+                b" MLST type*;size*;modify*;perm*;\r\n" +
+                (b" MODE Z\r\n" if deflate or compressobj else b""))
+msg_211_end = b"211 End\r\n"
+msg_213_list = b"213-Directory listing:\r\n"
+msg_213_done = b"213 Done.\r\n"
+msg_215_syst = b"215 UNIX Type: L8\r\n"
+msg_220_hello = "220 Hello, this is the {}.\r\n".format(sys.platform).encode()
+msg_221_bye = b"221 Bye.\r\n"
+msg_225_OK = b"225 OK\r\n"
+msg_226_abort = b"226 Abort done.\r\n"
+msg_226_done = b"226 Done.\r\n"
+msg_230_login = b"230 Logged in.\r\n"
+msg_250_OK = b"250 OK\r\n"
+msg_350_rename = b"350 Rename from\r\n"
+msg_400_busy = b"400 Device busy.\r\n"
+msg_425_busy = b"425 Transfer in progress.\r\n"
+msg_425_no_port = b"425 No data port available.\r\n"
+msg_426_abort = b"426 Transfer aborted.\r\n"
+msg_450_no_buffer = b"450 No buffer available.\r\n"
+msg_501_offset = b"501 Bad offset.\r\n"
+msg_501_option = b"501 Option not supported.\r\n"
+msg_502_unsupported = b"502 Unsupported command.\r\n"
+msg_504_fail = b"504 Fail\r\n"
+msg_530_login = b"530 Not logged in.\r\n"
+msg_550_fail = b"550 Fail\r\n"
+reply_buf = bytearray(80)  # numeric replies are formatted here
+reply_mv = memoryview(reply_buf)
+
+
+# Small LRU cache, whose entries expire after ttl ms
+class Cache:
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.keys = []  # least recently used first
+        self.items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is not None:
+            self.keys.remove(key)
+            if ticks_diff(ticks_ms(), item[0]) < self.ttl:
+                self.keys.append(key)
+                self.hits += 1
+                return item[1]
+            del self.items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        if key in self.items:
+            self.keys.remove(key)
+        elif len(self.keys) >= self.size:
+            del self.items[self.keys.pop(0)]
+        self.keys.append(key)
+        self.items[key] = (ticks_ms(), value)
+
+    # drop path and everything below it
+    def drop(self, path):
+        below = path.rstrip("/") + "/"
+        for key in self.keys[:]:
+            if key == path or key.startswith(below):
+                self.keys.remove(key)
+                del self.items[key]
+
+
+stat_cache = Cache(_CACHE_SIZE, _CACHE_TTL)
+dir_cache = Cache(_CACHE_SIZE // 8, _CACHE_TTL)
+
+
+def init_cache(size, ttl):
+    global stat_cache, dir_cache
+
+    stat_cache = Cache(size, ttl)
+    dir_cache = Cache(size // 8, ttl)
+
+
+def cached_stat(path):
+    stat = stat_cache.get(path)
+    if stat is None:
+        stat = uos.stat(path)
+        stat_cache.put(path, stat)
+    return stat
+
+
+# the ilistdir() entries of path, from the cache or streamed from the
+# file system. The directory is opened here, such that an error is
+# raised before the iteration starts.
+def cached_ilistdir(path):
+    entries = dir_cache.get(path)
+    if entries is None:
+        entries = cache_entries(path, ilistdir(path))
+    return entries
+
+
+# pass the entries through and cache them, if there are not too many
+def cache_entries(path, entries):
+    collected = []
+    for entry in entries:
+        if collected is not None:
+            if len(collected) < _CACHE_DIR_MAX:
+                collected.append(entry)
+            else:
+                collected = None
+        yield entry
+    if collected is not None:
+        dir_cache.put(path, collected)
+
+
+# sort entries by name, if there are not more than limit of them.
+# Otherwise they are passed on in the order of the file system, such
+# that at most limit entries are held in memory.
+def sort_entries(entries, limit):
+    entries = iter(entries)
+    head = []
+    for entry in entries:
+        head.append(entry)
+        if len(head) > limit:
+            yield from head
+            yield from entries
+            return
+    head.sort(key=lambda entry: entry[0].lower())
+    yield from head
+
+
+# the (path, stat) of all files and directories below root, which ends
+# with "/". The tree is walked with a stack of the directories still to
+# list, and each directory is streamed, such that only the names of the
+# pending directories are held in memory.
+def walk_tree(root):
+    dirs = [root]
+    while dirs:
+        prefix = dirs.pop()
+        for entry in ilistdir(prefix[:-1] or "/"):
+            name = prefix + entry[0]
+            stat = uos.stat(name)
+            if stat[0] & 0o170000 == 0o040000:
+                dirs.append(name + "/")
+            yield name, stat
+
+
+# put the ustar header of a file or directory with stat into buf, which
+# is zero filled. Directory names end with "/".
+def tar_header(buf, name, stat):
+    name = name.encode()
+    prefix = b""
+    if len(name) > 100:  # split at a "/" into prefix and name
+        split = name.find(b"/", len(name) - 101)
+        if split < 0 or split > 155:
+            raise OSError(errno.ENAMETOOLONG)
+        prefix, name = name[:split], name[split + 1:]
+    buf[0:len(name)] = name
+    is_dir = stat[0] & 0o170000 == 0o040000
+    buf[100:148] = "{:07o}\0{:07o}\0{:07o}\0{:011o}\0{:011o}\0".format(
+        0o755 if is_dir else 0o644, 0, 0, 0 if is_dir else stat[6],
+        (stat[8] + _epoch_offset) & 0o77777777777).encode()
+    buf[148:156] = b"        "  # the checksum counts as spaces
+    buf[156] = 0x35 if is_dir else 0x30  # type "5" or "0"
+    buf[257:265] = b"ustar\x0000"
+    buf[345:345 + len(prefix)] = prefix
+    buf[148:156] = "{:06o}\0 ".format(sum(buf[0:_TAR_BLOCK])).encode()
+
+
+# the value of an octal number field of a tar header
+def tar_number(field):
+    value = 0
+    for byte in field:
+        if 0x30 <= byte <= 0x37:
+            value = value * 8 + byte - 0x30
+        elif value > 0 or byte == 0:  # ends with NUL or space
+            break
+    return value
+
+
+# the path of a tar member in directory root, which ends with "/", or
+# None if it would be outside of root
+def tar_member_path(root, name):
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    return root + "/".join(parts)
+
+
+# create the directories of path, as far as they do not exist
+def make_dirs(path):
+    end = 0
+    while end >= 0:
+        end = path.find("/", end + 1)
+        try:
+            uos.mkdir(path[:end] if end > 0 else path)
+        except OSError:
+            pass  # exists already
+
+
+# forget path, what is below it and the listing of its directory
+def cache_drop(path):
+    stat_cache.drop(path)
+    dir_cache.drop(path)
+    dir_cache.drop(path[:path.rfind("/")] or "/")
+    hash_drop(path)
+
+
+# the weak checksum of rsync, the sums a and b carried over the pieces
+# of a block. The checksum of the block is b << 16 | a.
+def weak_sum(data, a, b):
+    for byte in data:
+        a = (a + byte) & 0xffff
+        b = (b + a) & 0xffff
+    return a, b
+
+
+# CRC32 with the methods of the hashlib objects
+class Crc32:
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32(data, self.value)
+
+    def digest(self):
+        value = self.value & 0xffffffff
+        return bytes((value >> 24, (value >> 16) & 0xff,
+                      (value >> 8) & 0xff, value & 0xff))
+
+
+# hash algorithms of HASH by name, and the names, preferred one first
+hash_algos = {}
+if hashlib is not None:
+    for name, attr in (("SHA-256", "sha256"), ("SHA-1", "sha1"),
+                       ("MD5", "md5")):
+        if hasattr(hashlib, attr):
+            hash_algos[name] = getattr(hashlib, attr)
+if crc32 is not None:
+    hash_algos["CRC32"] = Crc32
+hash_names = [name for name in ("SHA-256", "SHA-1", "MD5", "CRC32")
+              if name in hash_algos]
+
+
+# The hash index keeps the hashes computed by HASH with the size and
+# mtime of the file, as {(algorithm, path): (size, mtime, hash)}. It is
+# stored in the file hash_index_l, one line per entry. New entries are
+# appended, and the file is rewritten when entries are dropped.
+def load_hash_index():
+    global hash_entries, hash_lines
+
+    if hash_entries is None:
+        hash_entries = {}
+        hash_lines = 0
+        try:
+            with open(hash_index_l) as file:
+                for line in file:
+                    name, size, mtime, value, path = line.rstrip(
+                        "\n").split(" ", 4)
+                    hash_entries[(name, path)] = (int(size), int(mtime),
+                                                  value)
+                    hash_lines += 1
+        except:
+            pass  # no index yet
+    return hash_entries
+
+
+def save_hash_index(entries, mode):
+    global hash_lines
+
+    if not hash_index_l:
+        return
+    try:
+        with open(hash_index_l, mode) as file:
+            for (name, path), (size, mtime, value) in entries:
+                file.write("{} {} {} {} {}\n".format(
+                    name, size, mtime, value, path))
+        hash_lines = (hash_lines if mode == "a" else 0) + len(entries)
+    except:
+        pass
+    stat_cache.drop(hash_index_l)
+    dir_cache.drop(hash_index_l[:hash_index_l.rfind("/")] or "/")
+
+
+def hash_put(key, entry):
+    index = load_hash_index()
+    if key not in index and len(index) >= _HASH_INDEX_MAX:
+        del index[next(iter(index))]
+    index[key] = entry
+    if hash_lines >= 2 * _HASH_INDEX_MAX:  # mostly outdated lines
+        save_hash_index(list(index.items()), "w")
+    else:
+        save_hash_index([(key, entry)], "a")
+
+
+# forget the hashes of path and of the files below it
+def hash_drop(path):
+    index = load_hash_index()
+    below = path.rstrip("/") + "/"
+    keys = [key for key in index
+            if key[1] == path or key[1].startswith(below)]
+    if keys:
+        for key in keys:
+            del index[key]
+        save_hash_index(list(index.items()), "w")
+
+
+# socket-like wrapper of a MODE Z data connection. write() compresses
+# and readinto() decompresses the data with the socket semantics used by
+# the transfers, and complete() sends the end of the compressed stream.
+class ZStream:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.stream = None  # compressor or decompressor, made on first use
+        self.pending = b""  # compressed data not sent yet
+        self.reading = False
+
+    # compress data; None finishes the stream
+    def compress(self, data):
+        if deflate is None:
+            if self.stream is None:
+                self.stream = compressobj(6, 8, _ZLIB_WBITS)  # 8: DEFLATED
+            if data is None:
+                return self.stream.flush()
+            return self.stream.compress(data)
+        if self.stream is None:
+            self.sink = BytesIO()
+            self.stream = deflate.DeflateIO(self.sink, deflate.ZLIB,
+                                            _ZLIB_WBITS)
+        if data is not None:
+            self.stream.write(data)
+        else:
+            self.stream.close()  # writes the rest, keeps the sink open
+        size = self.sink.tell()
+        self.sink.seek(0)
+        return memoryview(self.sink.getvalue())[0:size]
+
+    # takes data once the previous output is sent; None until then
+    def write(self, data):
+        if len(self.pending) > 0:
+            bytes_sent = self.sock.write(self.pending)
+            if bytes_sent:
+                self.pending = self.pending[bytes_sent:]
+            if len(self.pending) > 0:
+                return None
+        self.pending = self.compress(data)
+        return len(data)
+
+    def readinto(self, buf):
+        self.reading = True
+        if deflate is not None:
+            if self.stream is None:
+                # DeflateIO cannot resume a short read, so read blocking
+                self.sock.settimeout(_DATA_TIMEOUT)
+                self.stream = deflate.DeflateIO(self.sock, deflate.ZLIB)
+            return self.stream.readinto(buf)
+        if self.stream is None:
+            self.stream = decompressobj()
+            self.input = bytearray(_ZLIB_INPUT)
+        data = self.stream.unconsumed_tail
+        if not data:
+            bytes_read = self.sock.readinto(self.input)
+            if not bytes_read:
+                if bytes_read == 0 and not self.stream.eof:
+                    raise OSError(errno.EIO)  # truncated stream
+                return bytes_read
+            data = memoryview(self.input)[0:bytes_read]
+        data = self.stream.decompress(data, len(buf))
+        buf[0:len(data)] = data
+        return len(data) or None
+
+    # run transfer, and when sending, the end of the compressed stream
+    def complete(self, transfer):
+        yield from transfer
+        if not self.reading:
+            yield from send_data(self.sock, self.pending)
+            yield from send_data(self.sock, self.compress(None))
+
+
+# socket-like wrapper of a MODE B data connection. The data is sent and
+# received in blocks of RFC 959 with a 3 byte header of descriptor and
+# count. The end of a transfer is told by a block with the EOF flag
+# instead of closing the connection, which thereby serves the next
+# transfer too.
+class BlockStream:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.header = bytearray(3)
+        self.header_left = 0  # header bytes still to be sent or received
+        self.count = 0  # data bytes left in the current block
+        self.eof = False  # the current block is the last one
+
+    def write(self, data):
+        if self.count == 0:  # start a block
+            self.count = min(len(data), 0xffff)
+            self.header[0] = 0
+            self.header[1] = self.count >> 8
+            self.header[2] = self.count & 0xff
+            self.header_left = 3
+        if self.header_left > 0:
+            bytes_sent = self.sock.write(
+                memoryview(self.header)[3 - self.header_left:3])
+            if bytes_sent:
+                self.header_left -= bytes_sent
+            if self.header_left > 0:
+                return None
+        bytes_sent = self.sock.write(data[0:self.count])
+        if bytes_sent:
+            self.count -= bytes_sent
+        return bytes_sent
+
+    def readinto(self, buf):
+        while self.count == 0:
+            if self.eof:
+                return 0
+            bytes_read = self.sock.readinto(
+                memoryview(self.header)[self.header_left:3])
+            if bytes_read == 0:
+                raise OSError(errno.EIO)  # closed before the EOF block
+            if bytes_read is None:
+                return None
+            self.header_left += bytes_read
+            if self.header_left == 3:
+                if self.header[0] & 0x10:  # restart markers are not supported
+                    raise OSError(errno.EINVAL)
+                self.header_left = 0
+                self.eof = self.header[0] & 0x40
+                self.count = self.header[1] << 8 | self.header[2]
+        bytes_read = self.sock.readinto(buf[0:min(len(buf), self.count)])
+        if bytes_read == 0:
+            raise OSError(errno.EIO)
+        if bytes_read:
+            self.count -= bytes_read
+        return bytes_read
+
+    # run transfer, and when sending, tell the end by an empty EOF block
+    def complete(self, transfer):
+        yield from transfer
+        if not self.eof:
+            yield from send_data(self.sock, b"\x40\x00\x00")
 
 
 class FTP_client:
@@ -57,70 +639,501 @@ class FTP_client:
         self.command_client.setsockopt(socket.SOL_SOCKET,
                                        _SO_REGISTER_HANDLER,
                                        self.exec_ftp_command)
-        self.command_client.sendall("220 Hello, this is the {}.\r\n".format(sys.platform))
+        self.command_client.sendall(msg_220_hello)
         self.cwd = '/'
         self.fromname = None
-#        self.logged_in = False
+        self.restart = 0  # offset set by REST for the next RETR or STOR
+        self.mode = "S"  # transfer mode, S(tream), B(lock) or Z (deflate)
+        self.block_client = None  # data connection kept open in MODE B
+        self.logged_in = False
+        self.extract = False  # STOR x.tar extracts, set by SITE EXTRACT
+        self.done_msg = None  # 226 reply of a transfer, if not the default
+        self.hash_name = hash_names[0] if hash_names else None  # of HASH
         self.act_data_addr = self.remote_addr
         self.DATA_PORT = 20
         self.active = True
         self.pasv_data_addr = local_addr
+        self.pasv_reply = "227 Entering Passive Mode ({},".format(
+            local_addr.replace('.', ',')).encode()  # the port follows
+        self.pasv_socket = None  # (socket, port) leased on PASV
+        self.data_stream = None  # passive connection, set by data_accept()
+        self.data_client = None
+        self.transfer = None  # generator of the running data transfer
+        self.data_tick = 0  # time of the last transfer progress
+        self.chunk_size = 0  # of the last or running transfer
+        self.rate = 0  # throughput of the last transfer in bytes/s
+        self.transfer_bytes = 0
+        self.buffer = None  # leased from buffer_pool
 
-    def send_list_data(self, path, data_client, full):
+    # The send/save methods are generators, which move one chunk
+    # per step. They yield the number of bytes moved, or None if the
+    # data socket was not ready.
+    def send_list_data(self, path, data_client, style):
+        pattern = None
         try:
-            for fname in uos.listdir(path):
-                data_client.sendall(self.make_description(path, fname, full))
+            entries = cached_ilistdir(path)
         except Exception as e:  # path may be a file name or pattern
             path, pattern = self.split_path(path)
+            pattern = self.compile_pattern(pattern)
             try:
-                for fname in uos.listdir(path):
-                    if self.fncmp(fname, pattern):
-                        data_client.sendall(
-                            self.make_description(path, fname, full))
+                entries = cached_ilistdir(path)
             except:
-                pass
+                entries = ()
+        if list_sort_l > 0:
+            entries = sort_entries(entries, list_sort_l)
+        # what is the same for all lines is determined once
+        year = localtime()[0]
+        prefix = path if path.endswith("/") else path + "/"
+        yield from self.send_lines(data_client, (
+            self.make_description(prefix, entry[0], style, year).encode()
+            for entry in entries
+            if pattern is None or self.fncmp(entry[0], pattern)))
+
+    # send the lines of a listing. They are collected in the buffer, or
+    # in mv if the lines are made with the buffer, which is sent when full.
+    def send_lines(self, data_client, lines, mv=None):
+        if mv is None:
+            mv = self.buffer
+        used = 0
+        for line in lines:
+            if used + len(line) > len(mv):
+                yield from send_data(data_client, mv[0:used])
+                stat_counts[_STAT_SENT] += used
+                used = 0
+            if len(line) > len(mv):
+                yield from send_data(data_client, line)
+                stat_counts[_STAT_SENT] += len(line)
+            else:
+                mv[used:used + len(line)] = line
+                used += len(line)
+        if used > 0:
+            yield from send_data(data_client, mv[0:used])
+            stat_counts[_STAT_SENT] += used
+
+    # SITE MANIFEST: the files and directories of the tree below path,
+    # one line each with the MLSD facts, the hash if in the hash index,
+    # and the path relative to path. The tree is walked with a stack of
+    # the directories still to list, and each directory is streamed.
+    def send_manifest_data(self, path, data_client):
+        yield from self.send_lines(data_client, self.manifest_lines(path))
+
+    def manifest_lines(self, path):
+        root = path if path.endswith("/") else path + "/"
+        index = load_hash_index()
+        for name, stat in walk_tree(root):
+            fact = ""
+            cached = index.get((self.hash_name, name))
+            if cached is not None and cached[0:2] == (stat[6], stat[8]):
+                fact = "hash={}:{};".format(self.hash_name, cached[2])
+            yield "{}{} {}\r\n".format(self.make_facts(stat), fact,
+                                         name[len(root):]).encode()
+
+    # RETR dir.tar and SITE TAR: the tree below path as ustar archive,
+    # which is made while it is sent. The headers and the file data go
+    # through the buffer, and nothing is stored.
+    def send_tar_data(self, path, data_client):
+        mv = self.buffer
+        if len(mv) < _TAR_BLOCK:
+            raise OSError(errno.ENOMEM)
+        zeros = memoryview(bytes(_TAR_BLOCK))
+        root = path if path.endswith("/") else path + "/"
+        top = self.split_path(path)[1]  # the archive has dir/...
+        top = top + "/" if top else ""
+        for name, stat in walk_tree(root):
+            is_dir = stat[0] & 0o170000 == 0o040000
+            mv[0:_TAR_BLOCK] = zeros
+            tar_header(mv, top + name[len(root):] + ("/" if is_dir else ""),
+                       stat)
+            yield from send_data(data_client, mv[0:_TAR_BLOCK])
+            stat_counts[_STAT_SENT] += _TAR_BLOCK
+            if is_dir:
+                continue
+            # send the size told in the header, even if the file changed
+            rest = stat[6]
+            with open(name, "rb") as file:
+                while rest > 0:
+                    bytes_read = file.readinto(
+                        mv[0:min(self.chunk_size, rest)])
+                    if bytes_read <= 0:
+                        raise OSError(errno.EIO)  # the file shrank
+                    yield from send_data(data_client, mv[0:bytes_read])
+                    stat_counts[_STAT_SENT] += bytes_read
+                    self.adapt_chunk(bytes_read)
+                    rest -= bytes_read
+            if stat[6] % _TAR_BLOCK:
+                yield from send_data(data_client,
+                                     zeros[stat[6] % _TAR_BLOCK:])
+        yield from send_data(data_client, zeros)  # two blocks end it
+        yield from send_data(data_client, zeros)
+
+    # SITE SUMS: the checksums of the blocks of the file path for a delta
+    # upload, after a line with the algorithm, the block size and the
+    # file size. Each block has a line with its index, the weak checksum
+    # of rsync and the hash. The file is read into the upper half of the
+    # buffer, and the lines are collected in the lower half.
+    def send_sums_data(self, path, data_client, block):
+        half = len(self.buffer) // 2
+        yield from self.send_lines(data_client,
+                                   self.sum_lines(path, block, half),
+                                   self.buffer[0:half])
+
+    def sum_lines(self, path, block, half):
+        mv = self.buffer[half:]
+        with open(path, "rb") as file:
+            yield "{} {} {}\r\n".format(self.hash_name, block,
+                                        uos.stat(path)[6]).encode()
+            index = 0
+            rest = block
+            while rest == block:  # the last block may be short
+                digest = hash_algos[self.hash_name]()
+                a = b = 0
+                while rest > 0:
+                    bytes_read = file.readinto(mv[0:min(rest, len(mv))])
+                    if bytes_read <= 0:
+                        break
+                    digest.update(mv[0:bytes_read])
+                    a, b = weak_sum(mv[0:bytes_read], a, b)
+                    rest -= bytes_read
+                if rest == block:  # EOF
+                    break
+                yield "{} {:08x} {}\r\n".format(
+                    index, b << 16 | a,
+                    hexlify(digest.digest()).decode()).encode()
+                index += 1
+                rest = block if rest == 0 else 0
 
-    def make_description(self, path, fname, full):
+    # the listing line of fname in directory prefix, which ends with "/".
+    # year is the current year.
+    def make_description(self, prefix, fname, style, year):
         global _month_name
-        if full:
-            stat = uos.stat(self.get_absolute_path(path, fname))
+        if style == _MLSD:
+            description = "{} {}\r\n".format(
+                self.make_facts(cached_stat(prefix + fname)), fname)
+        elif style == _LIST:
+            stat = cached_stat(prefix + fname)
             file_permissions = ("drwxr-xr-x"
                                 if (stat[0] & 0o170000 == 0o040000)
                                 else "-rw-r--r--")
             file_size = stat[6]
             tm = stat[7] & 0xffffffff
             tm = localtime(tm if tm < 0x80000000 else tm - 0x100000000)
-            if tm[0] != localtime()[0]:
-                description = "{} 1 owner group {:>10} {} {:2} {:>5} {}\r\n".\
-                    format(file_permissions, file_size,
-                        _month_name[tm[1]], tm[2], tm[0], fname)
+            if tm[0] != year:
+                description = _list_format_year.format(
+                    file_permissions, file_size,
+                    _month_name[tm[1]], tm[2], tm[0], fname)
             else:
-                description = "{} 1 owner group {:>10} {} {:2} {:02}:{:02} {}\r\n".\
-                    format(file_permissions, file_size,
-                        _month_name[tm[1]], tm[2], tm[3], tm[4], fname)
+                description = _list_format_time.format(
+                    file_permissions, file_size,
+                    _month_name[tm[1]], tm[2], tm[3], tm[4], fname)
         else:
             description = fname + "\r\n"
         return description
 
-    def send_file_data(self, path, data_client):
-        buffer = bytearray(_CHUNK_SIZE)
-        mv = memoryview(buffer)
+    # the MLSD/MLST facts of a stat result
+    def make_facts(self, stat):
+        tm = localtime(stat[8])
+        if stat[0] & 0o170000 == 0o040000:
+            file_type, file_perm = "dir", "elcfmpd"
+        else:
+            file_type, file_perm = "file", "rwadf"
+        return "type={};size={};perm={};" \
+               "modify={:04d}{:02d}{:02d}{:02d}{:02d}{:02d};".format(
+                file_type, stat[6], file_perm, *tm[0:6])
+
+    def send_file_data(self, path, data_client, offset):
+        mv = self.buffer
         with open(path, "rb") as file:
-            bytes_read = file.readinto(buffer)
+            if offset > 0:
+                file.seek(offset)
+            bytes_read = file.readinto(mv[0:self.chunk_size])
             while bytes_read > 0:
-                data_client.write(mv[0:bytes_read])
-                bytes_read = file.readinto(buffer)
-            data_client.close()
-
-    def save_file_data(self, path, data_client, mode):
-        buffer = bytearray(_CHUNK_SIZE)
-        mv = memoryview(buffer)
-        with open(path, mode) as file:
-            bytes_read = data_client.readinto(buffer)
-            while bytes_read > 0:
-                file.write(mv[0:bytes_read])
-                bytes_read = data_client.readinto(buffer)
-            data_client.close()
+                yield from send_data(data_client, mv[0:bytes_read])
+                stat_counts[_STAT_SENT] += bytes_read
+                self.adapt_chunk(bytes_read)
+                bytes_read = file.readinto(mv[0:self.chunk_size])
+
+    # The received data is collected in the buffer and written in blocks
+    # of write_size_l, aligned to the file position, which saves flash
+    # sector rewrites.
+    def save_file_data(self, path, data_client, mode, offset):
+        mv = self.buffer
+        cache_drop(path)
+        if offset > 0:  # resume, keeping what is before offset
+            if offset > uos.stat(path)[6]:
+                raise OSError(errno.EINVAL)
+            mode = "r+b"
+        block = min(write_size_l, len(mv))
+        if block > 0 and mode == "ab":
+            try:
+                offset = uos.stat(path)[6]
+            except:
+                pass  # a new file
+        # the first block ends at the next block boundary of the file
+        fill = block - offset % block if block > 0 else 0
+        used = 0
+        try:
+            with open(path, mode) as file:
+                if mode == "r+b":
+                    file.seek(offset)
+                while True:
+                    bytes_read = data_client.readinto(
+                        mv[used:used + min(self.chunk_size, fill - used)]
+                        if block > 0 else mv[0:self.chunk_size])
+                    if bytes_read == 0:  # EOF
+                        break
+                    if bytes_read is not None:
+                        used += bytes_read
+                        if used >= fill:
+                            file.write(mv[0:used])
+                            used = 0
+                            fill = block
+                        stat_counts[_STAT_RECEIVED] += bytes_read
+                        self.adapt_chunk(bytes_read)
+                    yield bytes_read
+                if used > 0:
+                    file.write(mv[0:used])
+        finally:
+            cache_drop(path)
+
+    # STOR x.tar with SITE EXTRACT ON: the ustar archive is parsed while
+    # it is received, and its members are written below directory path.
+    # Member data goes from the buffer straight to the files, and nothing
+    # of the archive is stored. The final reply tells the failed members.
+    def save_tar_data(self, path, data_client):
+        mv = self.buffer
+        root = path if path.endswith("/") else path + "/"
+        header = bytearray(_TAR_BLOCK)
+        have = 0  # bytes of the header received
+        rest = 0  # bytes of member data still to receive
+        skip = 0  # padding after the member data
+        member = None  # path of the member file being received
+        file = None  # and the file, None if it could not be written
+        done = 0
+        fails = []
+        failed = 0
+        end = False  # the zero block at the end of the archive came
+        try:
+            while True:
+                bytes_read = data_client.readinto(mv[0:self.chunk_size])
+                if bytes_read == 0:  # EOF
+                    break
+                if bytes_read is None:
+                    yield None
+                    continue
+                stat_counts[_STAT_RECEIVED] += bytes_read
+                self.adapt_chunk(bytes_read)
+                pos = 0
+                while pos < bytes_read and not end:
+                    if rest > 0:  # member data
+                        size = min(rest, bytes_read - pos)
+                        if file is not None:
+                            try:
+                                file.write(mv[pos:pos + size])
+                            except OSError:
+                                file.close()
+                                file = None
+                        rest -= size
+                        pos += size
+                    elif skip > 0:  # padding
+                        size = min(skip, bytes_read - pos)
+                        skip -= size
+                        pos += size
+                        continue
+                    else:  # header
+                        size = min(_TAR_BLOCK - have, bytes_read - pos)
+                        header[have:have + size] = mv[pos:pos + size]
+                        have += size
+                        pos += size
+                        if have < _TAR_BLOCK:
+                            continue
+                        have = 0
+                        # the checksum counts its own field as spaces
+                        checksum = sum(header) - sum(header[148:156]) + 256
+                        if checksum == 256:  # zero block
+                            end = True
+                            break
+                        if checksum != tar_number(header[148:156]):
+                            raise OSError(errno.EINVAL)  # no tar stream
+                        rest = tar_number(header[124:136])
+                        skip = -rest % _TAR_BLOCK
+                        name = bytes(header[0:100]).split(b"\0")[0]
+                        if header[257:263] == b"ustar\0" and header[345]:
+                            name = bytes(header[345:500]).split(
+                                b"\0")[0] + b"/" + name
+                        name = name.decode()
+                        member = tar_member_path(root, name)
+                        kind = header[156]
+                        if member is None:  # outside of path
+                            failed += 1
+                            if len(fails) < _TAR_FAILS:
+                                fails.append(name)
+                        elif kind == 0x35:  # directory "5"
+                            make_dirs(member)
+                            cache_drop(member)
+                            done += 1
+                            member = None
+                        elif kind not in (0x30, 0):  # links, pax headers
+                            member = None
+                        else:  # file "0"
+                            try:
+                                make_dirs(member[0:member.rfind("/")])
+                                file = open(member, "wb")
+                            except OSError:
+                                file = None
+                    if rest == 0 and member is not None:  # member done
+                        if file is not None:
+                            file.close()
+                            file = None
+                            done += 1
+                        else:
+                            failed += 1
+                            if len(fails) < _TAR_FAILS:
+                                fails.append(member[len(root):])
+                        cache_drop(member)
+                        member = None
+                yield bytes_read
+        finally:
+            if file is not None:
+                file.close()
+        if failed:
+            self.done_msg = "226-Extracted {} members, {} failed:\r\n" \
+                            "{}226 Done.\r\n".format(done, failed, "".join(
+                                " {}\r\n".format(name) for name in fails))
+        else:
+            self.done_msg = "226 Extracted {} members.\r\n".format(done)
+        self.done_msg = self.done_msg.encode()
+
+    # SITE DELTA: the file path is rebuilt from the received delta stream
+    # in the file path~, which replaces path at the end. The stream has
+    # records "C" index count, which copy count blocks of the file from
+    # block index on, and "L" length, followed by length bytes of new
+    # data. The numbers are 4 byte big endian. Records may be split over
+    # reads, and their heads are collected in head. The data is received
+    # into the lower half of the buffer, and copied with the upper half.
+    def save_delta_data(self, path, data_client, block):
+        mv = self.buffer
+        half = len(mv) // 2
+        temp = path + "~"
+        size = uos.stat(path)[6]
+        head = bytearray(9)
+        have = 0  # bytes of the record head received
+        need = 0  # length of the record head, 9 for "C" and 5 for "L"
+        rest = 0  # bytes of literal data still to receive
+        copied = 0
+        literal = 0
+        done = False
+        cache_drop(temp)
+        try:
+            with open(path, "rb") as source:
+                with open(temp, "wb") as target:
+                    while True:
+                        bytes_read = data_client.readinto(
+                            mv[0:min(self.chunk_size, half)])
+                        if bytes_read == 0:  # EOF
+                            break
+                        if bytes_read is None:
+                            yield None
+                            continue
+                        stat_counts[_STAT_RECEIVED] += bytes_read
+                        self.adapt_chunk(bytes_read)
+                        pos = 0
+                        while pos < bytes_read:
+                            if rest > 0:  # literal data
+                                count = min(rest, bytes_read - pos)
+                                target.write(mv[pos:pos + count])
+                                literal += count
+                                rest -= count
+                                pos += count
+                                continue
+                            if have == 0:
+                                need = (9 if mv[pos] == 0x43 else
+                                        5 if mv[pos] == 0x4c else 0)
+                                if need == 0:
+                                    raise OSError(errno.EINVAL)
+                            count = min(need - have, bytes_read - pos)
+                            head[have:have + count] = mv[pos:pos + count]
+                            have += count
+                            pos += count
+                            if have < need:
+                                continue
+                            have = 0
+                            value = (head[1] << 24 | head[2] << 16 |
+                                     head[3] << 8 | head[4])
+                            if head[0] == 0x4c:  # "L"
+                                rest = value
+                                continue
+                            # "C", the last block may be short
+                            if value * block >= size:
+                                raise OSError(errno.EINVAL)
+                            source.seek(value * block)
+                            count = min((head[5] << 24 | head[6] << 16 |
+                                         head[7] << 8 | head[8]) * block,
+                                        size - value * block)
+                            while count > 0:
+                                moved = source.readinto(
+                                    mv[half:half + min(count, half)])
+                                if moved <= 0:
+                                    raise OSError(errno.EIO)  # shrank
+                                target.write(mv[half:half + moved])
+                                copied += moved
+                                count -= moved
+                        yield bytes_read
+            if rest > 0 or have > 0:  # the stream ended within a record
+                raise OSError(errno.EINVAL)
+            try:
+                uos.rename(temp, path)
+            except OSError:  # file systems which do not replace path
+                uos.remove(path)
+                uos.rename(temp, path)
+            done = True
+        finally:
+            if not done:
+                try:
+                    uos.remove(temp)
+                except OSError:
+                    pass
+            cache_drop(temp)
+            cache_drop(path)
+        self.done_msg = "226 Delta applied, {} bytes copied, {} received." \
+                        "\r\n".format(copied, literal).encode()
+
+    # lease a transfer buffer from the pool. The transfer starts with
+    # chunks of the full buffer size.
+    def lease_buffer(self):
+        if self.buffer is None and buffer_pool:
+            self.buffer = buffer_pool.pop()
+            self.chunk_size = len(self.buffer)
+            self.chunk_grow = True
+            self.window_rate = self.window_bytes = 0
+            self.window_tick = ticks_ms()
+        return self.buffer
+
+    def release_buffer(self):
+        if self.buffer is not None:
+            buffer_pool.append(self.buffer)
+            self.buffer = None
+
+    # adapt the chunk size to the throughput: keep changing the size in
+    # the same direction while the throughput increases, and turn when
+    # it drops.
+    def adapt_chunk(self, size):
+        self.transfer_bytes += size
+        self.window_bytes += size
+        elapsed = ticks_diff(ticks_ms(), self.window_tick)
+        if elapsed >= _RATE_WINDOW:
+            rate = self.window_bytes * 1000 // elapsed
+            last = self.window_rate
+            if rate < last - (last >> 3):
+                self.chunk_grow = not self.chunk_grow
+            if rate < last - (last >> 3) or rate > last + (last >> 3):
+                if self.chunk_grow:
+                    self.chunk_size = min(self.chunk_size * 2,
+                                          len(self.buffer))
+                else:
+                    self.chunk_size = max(self.chunk_size // 2, chunk_min_l)
+            self.window_rate = rate
+            self.window_bytes = 0
+            self.window_tick = ticks_ms()
 
     def get_absolute_path(self, cwd, payload):
         # Just a few special cases "..", "." and ""
@@ -143,31 +1156,75 @@ class FTP_client:
         head = path[:-(len(tail) + 1)]
         return ('/' if head == '' else head, tail)
 
-    # compare fname against pattern. Pattern may contain
-    # the wildcards ? and *.
+    # compile a pattern for fncmp(). Pattern may contain the wildcards ? and *
+    # and character classes like [abc], [a-z] or [!abc]. The result is a tuple
+    # with one entry per pattern position: "" for *, None for ?, a string
+    # of the matching characters, or a 1-tuple of the characters not matching.
+    def compile_pattern(self, pattern):
+        tokens = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            i += 1
+            if c == "*":
+                if not tokens or tokens[-1] != "":  # ** is the same as *
+                    tokens.append("")
+            elif c == "?":
+                tokens.append(None)
+            elif c == "[":
+                start = i + 1 if pattern[i:i + 1] in ("!", "^") else i
+                end = pattern.find("]", start + 1)  # a leading ] is a member
+                if end < 0:  # no class, but a plain [
+                    tokens.append(c)
+                    continue
+                chars = ""
+                j = start
+                while j < end:
+                    if j + 2 < end and pattern[j + 1] == "-":  # range
+                        for k in range(ord(pattern[j]),
+                                       ord(pattern[j + 2]) + 1):
+                            chars += chr(k)
+                        j += 3
+                    else:
+                        chars += pattern[j]
+                        j += 1
+                tokens.append((chars,) if start > i else chars)
+                i = end + 1
+            else:
+                tokens.append(c)
+        return tuple(tokens)
+
+    # compare fname against a compiled pattern. The matching is iterative,
+    # going back to the last * on a mismatch, and does not slice fname.
     def fncmp(self, fname, pattern):
+        if type(pattern) is str:
+            pattern = self.compile_pattern(pattern)
         pi = 0
         si = 0
-        while pi < len(pattern) and si < len(fname):
-            if (fname[si] == pattern[pi]) or (pattern[pi] == '?'):
-                si += 1
-                pi += 1
-            else:
-                if pattern[pi] == '*':  # recurse
-                    if pi == len(pattern.rstrip("*?")):  # only wildcards left
-                        return True
-                    while si < len(fname):
-                        if self.fncmp(fname[si:], pattern[pi + 1:]):
-                            return True
-                        else:
-                            si += 1
-                    return False
-                else:
-                    return False
-        if pi == len(pattern.rstrip("*")) and si == len(fname):
-            return True
-        else:
-            return False
+        star = -1  # position of the last * in pattern
+        mark = 0  # position in fname where that * continues
+        while si < len(fname):
+            if pi < len(pattern):
+                token = pattern[pi]
+                if token == "":
+                    star = pi
+                    mark = si
+                    pi += 1
+                    continue
+                if (token is None or
+                        (fname[si] in token if type(token) is str
+                         else fname[si] not in token[0])):
+                    pi += 1
+                    si += 1
+                    continue
+            if star < 0:
+                return False
+            pi = star + 1
+            mark += 1
+            si = mark
+        while pi < len(pattern) and pattern[pi] == "":
+            pi += 1
+        return pi == len(pattern)
 
     def open_dataclient(self):
         if self.active:  # active mode
@@ -175,18 +1232,145 @@ class FTP_client:
             data_client.settimeout(_DATA_TIMEOUT)
             data_client.connect((self.act_data_addr, self.DATA_PORT))
             log_msg(1, "FTP Data connection with:", self.act_data_addr)
-        else:  # passive mode
-            data_client, data_addr = datasocket.accept()
-            log_msg(1, "FTP Data connection with:", data_addr[0])
+        else:  # passive mode, None if the client did not connect yet
+            if self.pasv_socket is None:
+                raise OSError(errno.EINVAL)  # no PASV before the transfer
+            data_client, self.data_stream = self.data_stream, None
         return data_client
 
+    # lease a passive data socket from the pool, keep the one we have
+    def lease_datasocket(self):
+        if self.pasv_socket is None and free_datasockets:
+            self.pasv_socket = free_datasockets.pop()
+        return self.pasv_socket
+
+    # return the passive data socket to the pool
+    def release_datasocket(self):
+        self.close_data_stream()
+        if self.pasv_socket is not None:
+            free_datasockets.append(self.pasv_socket)
+            self.pasv_socket = None
+
+    # open the data connection and queue the transfer for the scheduler.
+    # transfer is one of the send/save generator methods, which is called
+    # with path, the data connection and args. A passive transfer waits
+    # in the scheduler for the client to connect.
+    def start_transfer(self, cl, msg, transfer, path, *args):
+        if self.transfer is not None:
+            cl.sendall(msg_425_busy)
+            return
+        if self.lease_buffer() is None:
+            cl.sendall(msg_450_no_buffer)
+            self.release_datasocket()
+            return
+        try:
+            if self.block_client is not None:  # MODE B, connection kept
+                self.data_client, self.block_client = self.block_client, None
+            else:
+                self.data_client = self.open_dataclient()
+        except:
+            stat_counts[_STAT_DATA_FAIL] += 1
+            cl.sendall(msg_550_fail)
+            self.release_datasocket()
+            self.release_buffer()
+            return
+        if self.data_client is None:  # passive, not yet connected
+            self.transfer = self.accept_transfer(msg, transfer, path, args)
+        else:
+            self.data_client.settimeout(0)  # the scheduler must not block
+            cl.sendall(msg)
+            self.transfer = self.open_transfer(transfer, path,
+                                               self.data_client, args)
+        self.data_tick = self.transfer_tick = ticks_ms()
+        self.transfer_bytes = 0
+        transfer_list.append(self)
+        schedule_transfers()
+
+    # the generator of a transfer, which in MODE Z and B moves the data
+    # through a ZStream or BlockStream
+    def open_transfer(self, transfer, path, data_client, args):
+        if self.mode == "Z":
+            data_client = ZStream(data_client)
+        elif self.mode == "B":
+            data_client = BlockStream(data_client)
+        else:
+            return transfer(path, data_client, *args)
+        return data_client.complete(transfer(path, data_client, *args))
+
+    # the generator of a passive transfer, which was requested before the
+    # client connected. It starts the transfer once data_accept() got the
+    # connection.
+    def accept_transfer(self, msg, transfer, path, args):
+        tick = ticks_ms()
+        while self.data_stream is None:
+            if ticks_diff(ticks_ms(), tick) > _ACCEPT_TIMEOUT * 1000:
+                stat_counts[_STAT_DATA_FAIL] += 1
+                raise OSError(errno.ETIMEDOUT)
+            yield None
+        self.data_client = self.open_dataclient()
+        self.data_client.settimeout(0)
+        self.command_client.sendall(msg)
+        yield from self.open_transfer(transfer, path, self.data_client, args)
+
+    # close the data connection kept from the last transfer in MODE B
+    def close_block_client(self):
+        if self.block_client is not None:
+            self.block_client.close()
+            self.block_client = None
+
+    # close the passive data connection, which was not used by a transfer
+    def close_data_stream(self):
+        if self.data_stream is not None:
+            self.data_stream.close()
+            self.data_stream = None
+
+    # move the transfer by one chunk
+    def step_transfer(self):
+        try:
+            if next(self.transfer) is not None:
+                self.data_tick = ticks_ms()
+            elif ticks_diff(ticks_ms(), self.data_tick) > _DATA_TIMEOUT * 1000:
+                raise OSError(errno.ETIMEDOUT)
+        except StopIteration:
+            self.end_transfer(self.done_msg or msg_226_done, self.mode == "B")
+        except Exception as err:
+            log_msg(1, "Transfer failed:", err)
+            self.end_transfer(msg_550_fail)
+
+    # finish or abort the transfer and tell the result, if any. keep
+    # keeps the data connection for the next transfer in MODE B.
+    def end_transfer(self, msg=None, keep=False):
+        if self.transfer is None:
+            return
+        if self in transfer_list:
+            transfer_list.remove(self)
+        self.transfer.close()  # closes the file of an unfinished transfer
+        self.transfer = None
+        self.done_msg = None
+        stat_counts[_STAT_TRANSFERS if msg is not None and msg[0:3] == b"226"
+                    else _STAT_FAILED] += 1
+        if self.transfer_bytes > 0:
+            self.rate = self.transfer_bytes * 1000 // max(
+                ticks_diff(ticks_ms(), self.transfer_tick), 1)
+        if keep:
+            self.block_client = self.data_client
+        elif self.data_client is not None:  # None if never connected
+            self.data_client.close()
+        self.data_client = None
+        self.release_datasocket()
+        self.release_buffer()
+        if msg is not None:
+            try:
+                self.command_client.sendall(msg)
+            except:
+                pass
+
     def exec_ftp_command(self, cl):
-        global datasocket
         global client_busy
         global my_ip_addr
 
         try:
-            gc.collect()
+            start_us = ticks_us()
 
             try:
                 data = cl.readline().decode("utf-8").rstrip("\r\n")
@@ -204,184 +1388,26 @@ class FTP_client:
                 return
 
             if client_busy:  # check if another client is busy
-                cl.sendall("400 Device busy.\r\n")  # tell so the remote client
+                cl.sendall(msg_400_busy)  # tell so the remote client
+                stat_counts[_STAT_BUSY] += 1
                 return  # and quit
             client_busy = True  # now it's my turn
 
-            # check for log-in state may done here, like
-            # if self.logged_in == False and not command in\
-            #    ("USER", "PASS", "QUIT"):
-            #    cl.sendall("530 Not logged in.\r\n")
-            #    return
-
             command = data.split()[0].upper()
             payload = data[len(command):].lstrip()  # partition is missing
-            path = self.get_absolute_path(self.cwd, payload)
-            log_msg(1, "Command={}, Payload={}".format(command, payload))
-
-            if command == "USER":
-                # self.logged_in = True
-                cl.sendall("230 Logged in.\r\n")
-                # If you want to see a password,return
-                #   "331 Need password.\r\n" instead
-                # If you want to reject an user, return
-                #   "530 Not logged in.\r\n"
-            elif command == "PASS":
-                # you may check here for a valid password and return
-                # "530 Not logged in.\r\n" in case it's wrong
-                # self.logged_in = True
-                cl.sendall("230 Logged in.\r\n")
-            elif command == "SYST":
-                cl.sendall("215 UNIX Type: L8\r\n")
-            elif command in ("TYPE", "NOOP", "ABOR"):  # just accept & ignore
-                cl.sendall('200 OK\r\n')
-            elif command == "QUIT":
-                cl.sendall('221 Bye.\r\n')
-                close_client(cl)
-            elif command == "PWD" or command == "XPWD":
-                cl.sendall('257 "{}"\r\n'.format(self.cwd))
-            elif command == "CWD" or command == "XCWD":
-                try:
-                    if (uos.stat(path)[0] & 0o170000) == 0o040000:
-                        self.cwd = path
-                        cl.sendall('250 OK\r\n')
-                    else:
-                        cl.sendall('550 Fail\r\n')
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "PASV":
-                cl.sendall('227 Entering Passive Mode ({},{},{}).\r\n'.format(
-                    self.pasv_data_addr.replace('.', ','),
-                    _DATA_PORT >> 8, _DATA_PORT % 256))
-                self.active = False
-            elif command == "PORT":
-                items = payload.split(",")
-                if len(items) >= 6:
-                    self.act_data_addr = '.'.join(items[:4])
-                    if self.act_data_addr == "127.0.1.1":
-                        # replace by command session addr
-                        self.act_data_addr = self.remote_addr
-                    self.DATA_PORT = int(items[4]) * 256 + int(items[5])
-                    cl.sendall('200 OK\r\n')
-                    self.active = True
-                else:
-                    cl.sendall('504 Fail\r\n')
-            elif command == "LIST" or command == "NLST":
-                if payload.startswith("-"):
-                    option = payload.split()[0].lower()
-                    path = self.get_absolute_path(
-                            self.cwd, payload[len(option):].lstrip())
-                else:
-                    option = ""
-                try:
-                    data_client = self.open_dataclient()
-                    cl.sendall("150 Directory listing:\r\n")
-                    self.send_list_data(path, data_client,
-                                        command == "LIST" or 'l' in option)
-                    cl.sendall("226 Done.\r\n")
-                    data_client.close()
-                except:
-                    cl.sendall('550 Fail\r\n')
-                    if data_client is not None:
-                        data_client.close()
-            elif command == "RETR":
-                try:
-                    data_client = self.open_dataclient()
-                    cl.sendall("150 Opened data connection.\r\n")
-                    self.send_file_data(path, data_client)
-                    # if the next statement is reached,
-                    # the data_client was closed.
-                    data_client = None
-                    cl.sendall("226 Done.\r\n")
-                except:
-                    cl.sendall('550 Fail\r\n')
-                    if data_client is not None:
-                        data_client.close()
-            elif command == "STOR" or command == "APPE":
-                try:
-                    data_client = self.open_dataclient()
-                    cl.sendall("150 Opened data connection.\r\n")
-                    self.save_file_data(path, data_client,
-                                        "wb" if command == "STOR" else "ab")
-                    # if the next statement is reached,
-                    # the data_client was closed.
-                    data_client = None
-                    cl.sendall("226 Done.\r\n")
-                except:
-                    cl.sendall('550 Fail\r\n')
-                    if data_client is not None:
-                        data_client.close()
-            elif command == "SIZE":
-                try:
-                    cl.sendall('213 {}\r\n'.format(uos.stat(path)[6]))
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "MDTM":
-                try:
-                    tm=localtime(uos.stat(path)[8])
-                    cl.sendall('213 {:04d}{:02d}{:02d}{:02d}{:02d}{:02d}\r\n'.format(*tm[0:6]))
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "STAT":
-                if payload == "":
-                    cl.sendall("211-Connected to ({})\r\n"
-                               "    Data address ({})\r\n"
-                               "    TYPE: Binary STRU: File MODE: Stream\r\n"
-                               "    Session timeout {}\r\n"
-                               "211 Client count is {}\r\n".format(
-                                self.remote_addr, self.pasv_data_addr,
-                                _COMMAND_TIMEOUT, len(client_list)))
-                else:
-                    cl.sendall("213-Directory listing:\r\n")
-                    self.send_list_data(path, cl, True)
-                    cl.sendall("213 Done.\r\n")
-            elif command == "DELE":
-                try:
-                    uos.remove(path)
-                    cl.sendall('250 OK\r\n')
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "RNFR":
-                try:
-                    # just test if the name exists, exception if not
-                    uos.stat(path)
-                    self.fromname = path
-                    cl.sendall("350 Rename from\r\n")
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "RNTO":
-                    try:
-                        uos.rename(self.fromname, path)
-                        cl.sendall('250 OK\r\n')
-                    except:
-                        cl.sendall('550 Fail\r\n')
-                    self.fromname = None
-            elif command == "CDUP" or command == "XCUP":
-                self.cwd = self.get_absolute_path(self.cwd, "..")
-                cl.sendall('250 OK\r\n')
-            elif command == "RMD" or command == "XRMD":
-                try:
-                    uos.rmdir(path)
-                    cl.sendall('250 OK\r\n')
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "MKD" or command == "XMKD":
-                try:
-                    uos.mkdir(path)
-                    cl.sendall('250 OK\r\n')
-                except:
-                    cl.sendall('550 Fail\r\n')
-            elif command == "SITE":
-                try:
-                    exec(payload.replace('\0','\n'))
-                    cl.sendall('250 OK\r\n')
-                except:
-                    cl.sendall('550 Fail\r\n')
+            log_msg(1, "Command=", command, "Payload=", payload)
+
+            handler, flags = self.commands.get(
+                command, (FTP_client.cmd_unsupported, 0))
+            collect_garbage(flags & _GC)
+            if flags & _LOGIN and not self.logged_in:
+                cl.sendall(msg_530_login)
             else:
-                cl.sendall("502 Unsupported command.\r\n")
-                # log_msg(2,
-                #  "Unsupported command {} with payload {}".format(command,
-                #  payload))
+                handler(self, cl, command, payload,
+                        self.get_absolute_path(self.cwd, payload)
+                        if flags & _PATH else None)
+            stat_command(stat_index.get(command, len(stat_verbs) - 1),
+                         ticks_diff(ticks_us(), start_us))
         except OSError as err:
             if verbose_l > 0:
                 log_msg(1, "Exception in exec_ftp_command:")
@@ -393,6 +1419,564 @@ class FTP_client:
             log_msg(1, "Exception in exec_ftp_command: {}".format(err))
         # tidy up before leaving
         client_busy = False
+        schedule_transfers()
+
+    # The command handlers are called by exec_ftp_command() through the
+    # table commands with the command socket, the command, the payload
+    # and the absolute path of the payload, if flagged with _PATH.
+    def cmd_user(self, cl, command, payload, path):
+        self.logged_in = True
+        cl.sendall(msg_230_login)
+        # If you want to see a password,return
+        #   "331 Need password.\r\n" instead
+        # If you want to reject an user, return
+        #   "530 Not logged in.\r\n"
+
+    def cmd_pass(self, cl, command, payload, path):
+        # you may check here for a valid password and return
+        # "530 Not logged in.\r\n" in case it's wrong
+        self.logged_in = True
+        cl.sendall(msg_230_login)
+
+    def cmd_syst(self, cl, command, payload, path):
+        cl.sendall(msg_215_syst)
+
+    def cmd_feat(self, cl, command, payload, path):
+        cl.sendall(msg_211_feat)
+        if hash_names:  # the selected one is marked by *
+            cl.sendall(" HASH {}\r\n".format(";".join(
+                name + "*" if name == self.hash_name else name
+                for name in hash_names)))
+        cl.sendall(msg_211_end)
+
+    def cmd_opts(self, cl, command, payload, path):
+        option = payload.split()
+        if len(option) == 0 or option[0].upper() != "HASH":
+            cl.sendall(msg_501_option)
+        elif len(option) > 1 and option[1].upper() not in hash_algos:
+            cl.sendall("501 Unknown algorithm.\r\n")
+        else:
+            if len(option) > 1:
+                self.hash_name = option[1].upper()
+            cl.sendall("200 {}\r\n".format(self.hash_name))
+
+    def cmd_noop(self, cl, command, payload, path):  # just accept & ignore
+        cl.sendall(msg_200_OK)
+
+    def cmd_mode(self, cl, command, payload, path):
+        if payload.upper() in ("S", "B") or (
+                payload.upper() == "Z" and (deflate or compressobj)):
+            self.mode = payload.upper()
+            self.close_block_client()
+            cl.sendall(msg_200_OK)
+        else:
+            cl.sendall(msg_504_fail)
+
+    def cmd_abor(self, cl, command, payload, path):
+        if self.transfer is not None:
+            self.end_transfer(msg_426_abort)
+            cl.sendall(msg_226_abort)
+        else:
+            cl.sendall(msg_225_OK)
+
+    def cmd_quit(self, cl, command, payload, path):
+        cl.sendall(msg_221_bye)
+        close_client(cl)
+
+    def cmd_pwd(self, cl, command, payload, path):
+        cl.sendall('257 "{}"\r\n'.format(self.cwd))
+
+    def cmd_cwd(self, cl, command, payload, path):
+        try:
+            if (cached_stat(path)[0] & 0o170000) == 0o040000:
+                self.cwd = path
+                cl.sendall(msg_250_OK)
+            else:
+                cl.sendall(msg_550_fail)
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_cdup(self, cl, command, payload, path):
+        self.cwd = self.get_absolute_path(self.cwd, "..")
+        cl.sendall(msg_250_OK)
+
+    def cmd_pasv(self, cl, command, payload, path):
+        self.close_block_client()
+        self.close_data_stream()  # the client connects anew
+        if self.lease_datasocket() is None:
+            cl.sendall(msg_425_no_port)
+        else:
+            data_port = self.pasv_socket[1]
+            send_numbers(cl, self.pasv_reply,
+                         (data_port >> 8, data_port % 256),
+                         b").\r\n", sep=b",")
+            self.active = False
+
+    def cmd_port(self, cl, command, payload, path):
+        items = payload.split(",")
+        if len(items) >= 6:
+            self.act_data_addr = '.'.join(items[:4])
+            if self.act_data_addr == "127.0.1.1":
+                # replace by command session addr
+                self.act_data_addr = self.remote_addr
+            self.DATA_PORT = int(items[4]) * 256 + int(items[5])
+            cl.sendall(msg_200_OK)
+            self.active = True
+            self.close_block_client()
+            self.release_datasocket()
+        else:
+            cl.sendall(msg_504_fail)
+
+    def cmd_list(self, cl, command, payload, path):
+        if payload.startswith("-"):
+            option = payload.split()[0].lower()
+            payload = payload[len(option):].lstrip()
+        else:
+            option = ""
+        self.start_transfer(cl, msg_150_list,
+                            self.send_list_data,
+                            self.get_absolute_path(self.cwd, payload),
+                            _LIST if command == "LIST" or
+                            'l' in option else _NLST)
+
+    def cmd_mlsd(self, cl, command, payload, path):
+        self.start_transfer(cl, msg_150_list,
+                            self.send_list_data, path, _MLSD)
+
+    def cmd_mlst(self, cl, command, payload, path):
+        try:
+            cl.sendall("250-Listing {}\r\n {} {}\r\n250 End\r\n".format(
+                payload, self.make_facts(cached_stat(path)), path))
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_rest(self, cl, command, payload, path):
+        try:
+            self.restart = int(payload)
+            if self.restart < 0:
+                raise ValueError
+            send_numbers(cl, b"350 Restarting at ", (self.restart,), b".\r\n")
+        except:
+            self.restart = 0
+            cl.sendall(msg_501_offset)
+
+    def cmd_retr(self, cl, command, payload, path):
+        if self.is_tar_tree(path):  # dir.tar of a directory dir
+            self.start_transfer(cl, msg_150_open, self.send_tar_data,
+                                path[:-4] or "/")
+        else:
+            self.start_transfer(cl, msg_150_open,
+                                self.send_file_data, path, self.restart)
+        self.restart = 0
+
+    # whether path is dir.tar of a directory dir, with no file of that name
+    def is_tar_tree(self, path):
+        if not path.endswith(".tar"):
+            return False
+        try:
+            cached_stat(path)
+            return False
+        except:
+            pass
+        try:
+            return cached_stat(path[:-4] or "/")[0] & 0o170000 == 0o040000
+        except:
+            return False
+
+    def cmd_stor(self, cl, command, payload, path):
+        if self.extract and command == "STOR" and path.endswith(".tar"):
+            # the members go to the directory of the archive
+            self.start_transfer(cl, msg_150_open, self.save_tar_data,
+                                self.split_path(path)[0])
+        else:
+            self.start_transfer(cl, msg_150_open,
+                                self.save_file_data, path,
+                                "wb" if command == "STOR" else "ab",
+                                self.restart if command == "STOR" else 0)
+        self.restart = 0
+
+    def cmd_size(self, cl, command, payload, path):
+        try:
+            send_numbers(cl, b"213 ", (cached_stat(path)[6],))
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_mdtm(self, cl, command, payload, path):
+        try:
+            tm = localtime(cached_stat(path)[8])
+            send_numbers(cl, b"213 ", tm[0:6], width=2)
+        except:
+            cl.sendall(msg_550_fail)
+
+    # HASH tells the hash of a file with the algorithm selected by OPTS
+    # HASH, XMD5, XCRC and XSHA256 with the one of their name
+    def cmd_hash(self, cl, command, payload, path):
+        name = self.hash_name if command == "HASH" else {
+            "XMD5": "MD5", "XCRC": "CRC32", "XSHA256": "SHA-256"}[command]
+        if name not in hash_algos:
+            cl.sendall(msg_504_fail)
+        elif self.transfer is not None or self.lease_buffer() is None:
+            cl.sendall(msg_450_no_buffer)
+        else:
+            try:
+                stat = uos.stat(path)
+                value = self.file_hash(name, path, stat)
+                if command == "HASH":
+                    cl.sendall("213 {} 0-{} {} {}\r\n".format(
+                        name, stat[6], value, payload))
+                else:
+                    cl.sendall("250 {}\r\n".format(value))
+            except:
+                cl.sendall(msg_550_fail)
+            finally:
+                self.release_buffer()
+
+    # the hash of a file from the hash index, or computed and put there,
+    # if the file changed or is not in the index
+    def file_hash(self, name, path, stat):
+        if stat[0] & 0o170000 == 0o040000:
+            raise OSError(errno.EISDIR)
+        entry = load_hash_index().get((name, path))
+        if entry is not None and entry[0:2] == (stat[6], stat[8]):
+            return entry[2]
+        digest = hash_algos[name]()
+        mv = self.buffer
+        with open(path, "rb") as file:
+            bytes_read = file.readinto(mv)
+            while bytes_read > 0:
+                digest.update(mv[0:bytes_read])
+                bytes_read = file.readinto(mv)
+        value = hexlify(digest.digest()).decode()
+        hash_put((name, path), (stat[6], stat[8], value))
+        return value
+
+    def cmd_stat(self, cl, command, payload, path):
+        if payload == "":
+            cl.sendall("211-Connected to ({})\r\n"
+                       "    Data address ({})\r\n"
+                       "    TYPE: Binary STRU: File MODE: {}\r\n"
+                       "    Session timeout {}\r\n"
+                       "    Chunk size {} Throughput {} B/s\r\n"
+                       "    Cache hits {} misses {}\r\n"
+                       "    Transfers {} failed {} Data connect fails {}\r\n"
+                       "    Bytes sent {} received {} Busy rejections {}\r\n"
+                       "    Garbage collections {} time {} us\r\n"
+                       "{}"
+                       "211 Client count is {}\r\n".format(
+                        self.remote_addr, self.pasv_data_addr,
+                        {"S": "Stream", "B": "Block",
+                         "Z": "Deflate"}[self.mode],
+                        _COMMAND_TIMEOUT, self.chunk_size, self.rate,
+                        stat_cache.hits + dir_cache.hits,
+                        stat_cache.misses + dir_cache.misses,
+                        stat_counts[_STAT_TRANSFERS],
+                        stat_counts[_STAT_FAILED],
+                        stat_counts[_STAT_DATA_FAIL],
+                        stat_counts[_STAT_SENT], stat_counts[_STAT_RECEIVED],
+                        stat_counts[_STAT_BUSY],
+                        stat_counts[_STAT_GC], stat_counts[_STAT_GC_TIME],
+                        "".join("    {} calls {} time {} max {} us\r\n".format(
+                            verb, stat_calls[i], stat_time[i], stat_max[i])
+                                for i, verb in enumerate(stat_verbs)
+                                if stat_calls[i] > 0),
+                        len(client_list)))
+        elif self.transfer is not None or self.lease_buffer() is None:
+            cl.sendall(msg_450_no_buffer)
+        else:
+            cl.sendall(msg_213_list)
+            try:
+                for _ in self.send_list_data(
+                        self.get_absolute_path(self.cwd, payload), cl, _LIST):
+                    pass
+            finally:
+                self.release_buffer()
+            cl.sendall(msg_213_done)
+
+    def cmd_dele(self, cl, command, payload, path):
+        try:
+            uos.remove(path)
+            cache_drop(path)
+            cl.sendall(msg_250_OK)
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_rnfr(self, cl, command, payload, path):
+        try:
+            # just test if the name exists, exception if not
+            cached_stat(path)
+            self.fromname = path
+            cl.sendall(msg_350_rename)
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_rnto(self, cl, command, payload, path):
+        try:
+            uos.rename(self.fromname, path)
+            cache_drop(self.fromname)
+            cache_drop(path)
+            cl.sendall(msg_250_OK)
+        except:
+            cl.sendall(msg_550_fail)
+        self.fromname = None
+
+    def cmd_rmd(self, cl, command, payload, path):
+        try:
+            uos.rmdir(path)
+            cache_drop(path)
+            cl.sendall(msg_250_OK)
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_mkd(self, cl, command, payload, path):
+        try:
+            uos.mkdir(path)
+            cache_drop(path)
+            cl.sendall(msg_250_OK)
+        except:
+            cl.sendall(msg_550_fail)
+
+    def cmd_site(self, cl, command, payload, path):
+        verb = payload.split(" ", 1)[0].upper()
+        if verb in self.site_commands:  # else payload is Python code
+            payload = payload[len(verb):].lstrip()
+            self.site_commands[verb](self, cl, verb, payload,
+                                     self.get_absolute_path(self.cwd, payload))
+            return
+        try:
+            exec(payload.replace('\0', '\n'))
+            cl.sendall(msg_250_OK)
+        except:
+            cl.sendall(msg_550_fail)
+        # the code may have changed files
+        init_cache(stat_cache.size, stat_cache.ttl)
+
+    def site_manifest(self, cl, command, payload, path):
+        try:
+            if uos.stat(path)[0] & 0o170000 != 0o040000:
+                raise OSError(errno.ENOTDIR)
+        except:
+            cl.sendall(msg_550_fail)
+            return
+        self.start_transfer(cl, msg_150_list, self.send_manifest_data, path)
+
+    def site_tar(self, cl, command, payload, path):
+        try:
+            if uos.stat(path)[0] & 0o170000 != 0o040000:
+                raise OSError(errno.ENOTDIR)
+        except:
+            cl.sendall(msg_550_fail)
+            return
+        self.start_transfer(cl, msg_150_open, self.send_tar_data, path)
+
+    def site_extract(self, cl, command, payload, path):
+        if payload.upper() in ("ON", "OFF"):
+            self.extract = payload.upper() == "ON"
+            cl.sendall("200 Extract {}.\r\n".format(payload.upper()))
+        else:
+            cl.sendall(msg_501_option)
+
+    # SITE SUMS size path and SITE DELTA size path, with the block size
+    def site_sums(self, cl, command, payload, path):
+        args = payload.split(" ", 1)
+        try:
+            block = int(args[0])
+            path = self.get_absolute_path(self.cwd, args[1].lstrip())
+            if not 0 < block <= _DELTA_BLOCK_MAX:
+                raise ValueError
+        except:
+            cl.sendall(msg_501_option)
+            return
+        if command == "SUMS" and self.hash_name not in hash_algos:
+            cl.sendall(msg_504_fail)
+            return
+        try:
+            if uos.stat(path)[0] & 0o170000 == 0o040000:
+                raise OSError(errno.EISDIR)
+        except:
+            cl.sendall(msg_550_fail)
+            return
+        if command == "SUMS":
+            self.start_transfer(cl, msg_150_list, self.send_sums_data, path,
+                                block)
+        else:
+            self.start_transfer(cl, msg_150_open, self.save_delta_data, path,
+                                block)
+
+    def cmd_unsupported(self, cl, command, payload, path):
+        cl.sendall(msg_502_unsupported)
+        # log_msg(2,
+        #  "Unsupported command {} with payload {}".format(command,
+        #  payload))
+
+    # handler and flags by command
+    commands = {
+        "USER": (cmd_user, 0),
+        "PASS": (cmd_pass, 0),
+        "SYST": (cmd_syst, 0),
+        "FEAT": (cmd_feat, 0),
+        "TYPE": (cmd_noop, 0),
+        "NOOP": (cmd_noop, 0),
+        "MODE": (cmd_mode, _LOGIN),
+        "ABOR": (cmd_abor, _LOGIN),
+        "QUIT": (cmd_quit, 0),
+        "PWD": (cmd_pwd, _LOGIN),
+        "XPWD": (cmd_pwd, _LOGIN),
+        "CWD": (cmd_cwd, _LOGIN | _PATH),
+        "XCWD": (cmd_cwd, _LOGIN | _PATH),
+        "CDUP": (cmd_cdup, _LOGIN),
+        "XCUP": (cmd_cdup, _LOGIN),
+        "PASV": (cmd_pasv, _LOGIN),
+        "PORT": (cmd_port, _LOGIN),
+        "LIST": (cmd_list, _LOGIN | _GC),
+        "NLST": (cmd_list, _LOGIN | _GC),
+        "MLSD": (cmd_mlsd, _LOGIN | _PATH | _GC),
+        "MLST": (cmd_mlst, _LOGIN | _PATH),
+        "REST": (cmd_rest, _LOGIN),
+        "RETR": (cmd_retr, _LOGIN | _PATH | _GC),
+        "STOR": (cmd_stor, _LOGIN | _PATH | _GC),
+        "APPE": (cmd_stor, _LOGIN | _PATH | _GC),
+        "SIZE": (cmd_size, _LOGIN | _PATH),
+        "MDTM": (cmd_mdtm, _LOGIN | _PATH),
+        "STAT": (cmd_stat, _LOGIN | _GC),
+        "DELE": (cmd_dele, _LOGIN | _PATH),
+        "RNFR": (cmd_rnfr, _LOGIN | _PATH),
+        "RNTO": (cmd_rnto, _LOGIN | _PATH),
+        "RMD": (cmd_rmd, _LOGIN | _PATH),
+        "XRMD": (cmd_rmd, _LOGIN | _PATH),
+        "MKD": (cmd_mkd, _LOGIN | _PATH),
+        "XMKD": (cmd_mkd, _LOGIN | _PATH),
+        "SITE": (cmd_site, _LOGIN | _GC),
+        "OPTS": (cmd_opts, 0),
+        "HASH": (cmd_hash, _LOGIN | _PATH | _GC),
+        "XMD5": (cmd_hash, _LOGIN | _PATH | _GC),
+        "XCRC": (cmd_hash, _LOGIN | _PATH | _GC),
+        "XSHA256": (cmd_hash, _LOGIN | _PATH | _GC),
+    }
+
+    # handlers of SITE by the first word of the payload, which are called
+    # with the rest of the payload and its absolute path
+    site_commands = {
+        "MANIFEST": site_manifest,
+        "TAR": site_tar,
+        "EXTRACT": site_extract,
+        "SUMS": site_sums,
+        "DELTA": site_sums,
+    }
+
+
+# Statistics of the commands by index in stat_verbs, and the counters
+# of stat_counts. They are fixed size arrays, such that recording needs
+# no allocation.
+stat_verbs = sorted(FTP_client.commands) + ["other"]  # other: unsupported
+stat_index = {verb: i for i, verb in enumerate(stat_verbs)}
+stat_calls = array("L", [0] * len(stat_verbs))
+stat_time = array("L", [0] * len(stat_verbs))  # us
+stat_max = array("L", [0] * len(stat_verbs))  # us
+stat_counts = array("L", [0] * _STAT_COUNTS)
+
+
+def stat_command(index, time):
+    stat_calls[index] += 1
+    stat_time[index] += time
+    if time > stat_max[index]:
+        stat_max[index] = time
+
+
+# collect garbage if forced or the free heap is below gc_free_l
+def collect_garbage(force):
+    if force or mem_free() < gc_free_l:
+        start_us = ticks_us()
+        gc.collect()
+        stat_counts[_STAT_GC] += 1
+        stat_counts[_STAT_GC_TIME] += ticks_diff(ticks_us(), start_us)
+
+
+# the statistics as dictionary, and optionally reset them
+def stats(reset=False):
+    result = {
+        "commands": {verb: (stat_calls[i], stat_time[i], stat_max[i])
+                     for i, verb in enumerate(stat_verbs) if stat_calls[i]},
+        "sent": stat_counts[_STAT_SENT],
+        "received": stat_counts[_STAT_RECEIVED],
+        "transfers": stat_counts[_STAT_TRANSFERS],
+        "failed": stat_counts[_STAT_FAILED],
+        "data_fail": stat_counts[_STAT_DATA_FAIL],
+        "busy": stat_counts[_STAT_BUSY],
+        "gc": stat_counts[_STAT_GC],
+        "gc_time": stat_counts[_STAT_GC_TIME],
+    }
+    if reset:
+        for counts in (stat_calls, stat_time, stat_max, stat_counts):
+            for i in range(len(counts)):
+                counts[i] = 0
+    return result
+
+
+# allocate the pool of transfer buffers, each as large as the free heap
+# allows within chunk_min_l and chunk_max_l
+def alloc_buffer_pool(count):
+    global buffer_pool
+
+    buffer_pool = []
+    gc.collect()
+    for _ in range(count):
+        size = chunk_max_l
+        while size > chunk_min_l and size * _CHUNK_HEAP_SHARE > mem_free():
+            size //= 2
+        buffer_pool.append(memoryview(bytearray(size)))
+
+
+# send head, the numbers with at least width decimal digits each and sep
+# between them, and tail as one reply, which is formatted in reply_buf
+def send_numbers(cl, head, numbers, tail=b"\r\n", width=1, sep=b""):
+    pos = len(head)
+    reply_buf[0:pos] = head
+    for value in numbers:
+        if sep and pos > len(head):
+            reply_buf[pos:pos + len(sep)] = sep
+            pos += len(sep)
+        digits = 1
+        rest = value
+        while rest >= 10:
+            rest //= 10
+            digits += 1
+        end = pos + max(digits, width)
+        for i in range(end - 1, pos - 1, -1):
+            reply_buf[i] = 0x30 + value % 10
+            value //= 10
+        pos = end
+    reply_buf[pos:pos + len(tail)] = tail
+    cl.sendall(reply_mv[0:pos + len(tail)])
+
+
+# write all of buf to a non-blocking socket, one chunk per step
+def send_data(sock, buf):
+    while len(buf) > 0:
+        bytes_sent = sock.write(buf)
+        if bytes_sent:
+            buf = buf[bytes_sent:]
+        yield bytes_sent
+
+
+# move all running transfers by one chunk, round robin
+def run_transfers(_):
+    global transfer_scheduled
+    transfer_scheduled = False
+    if not client_busy:  # do not interfere with a running command
+        for client in transfer_list[:]:
+            client.step_transfer()
+    schedule_transfers()
+
+
+# have the scheduler call run_transfers, as long as there is work
+def schedule_transfers():
+    global transfer_scheduled
+    if transfer_list and not transfer_scheduled:
+        try:
+            schedule(run_transfers, None)
+            transfer_scheduled = True
+        except RuntimeError:  # queue full; the next callback retries
+            pass
 
 
 def log_msg(level, *args):
@@ -407,10 +1991,32 @@ def close_client(cl):
     cl.close()
     for i, client in enumerate(client_list):
         if client.command_client == cl:
+            client.end_transfer()
+            client.release_datasocket()
+            client.close_block_client()
             del client_list[i]
             break
 
 
+# hand a passive data connection to the session which leased the socket
+def data_accept(datasocket):
+    try:
+        data_client, data_addr = datasocket.accept()
+    except:
+        return
+    for client in client_list:
+        # a late connect from another host must not get the data stream
+        if (client.pasv_socket is not None and
+                client.pasv_socket[0] is datasocket and
+                client.remote_addr == data_addr[0] and
+                client.data_stream is None):
+            log_msg(1, "FTP Data connection with:", data_addr[0])
+            client.data_stream = data_client
+            return
+    log_msg(1, "Rejected data connection from:", data_addr[0])
+    data_client.close()
+
+
 def accept_ftp_connect(ftpsocket, local_addr):
     # Accept new calls for the server
     try:
@@ -432,37 +2038,58 @@ def num_ip(ip):
 
 
 def stop():
-    global ftpsockets, datasocket
-    global client_list
+    global ftpsockets, datasockets, free_datasockets
+    global client_list, transfer_list
     global client_busy
 
     for client in client_list:
+        client.end_transfer()
+        client.release_datasocket()
         client.command_client.setsockopt(socket.SOL_SOCKET,
                                          _SO_REGISTER_HANDLER, None)
         client.command_client.close()
     del client_list
     client_list = []
+    transfer_list = []
     client_busy = False
     for sock in ftpsockets:
         sock.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER, None)
         sock.close()
     ftpsockets = []
-    if datasocket is not None:
-        datasocket.close()
-        datasocket = None
+    for sock, port in datasockets:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER, None)
+        sock.close()
+    datasockets = []
+    free_datasockets = []
 
 
 # start listening for ftp connections on port 21
-def start(port=21, verbose=0, splash=True):
-    global ftpsockets, datasocket
-    global verbose_l
+def start(port=21, verbose=0, splash=True,
+          data_port=_DATA_PORT, data_ports=_DATA_PORTS,
+          chunk_min=_CHUNK_MIN, chunk_max=_CHUNK_MAX, buffers=_BUFFERS,
+          cache_size=_CACHE_SIZE, cache_ttl=_CACHE_TTL, list_sort=0,
+          write_size=_WRITE_SIZE, gc_free=_GC_FREE,
+          hash_index="/.hashindex"):
+    global ftpsockets, datasockets, free_datasockets
+    global verbose_l, chunk_min_l, chunk_max_l, list_sort_l, write_size_l
+    global gc_free_l, hash_index_l, hash_entries
     global client_list
     global client_busy
+    import network
 
     alloc_emergency_exception_buf(100)
     verbose_l = verbose
+    chunk_min_l = chunk_min
+    chunk_max_l = max(chunk_min, chunk_max)
+    list_sort_l = list_sort
+    write_size_l = write_size
+    gc_free_l = gc_free
+    hash_index_l = hash_index
+    hash_entries = None
     client_list = []
     client_busy = False
+    alloc_buffer_pool(buffers)
+    init_cache(cache_size, cache_ttl)
 
     for interface in [network.AP_IF, network.STA_IF]:
         wlan = network.WLAN(interface)
@@ -482,16 +2109,25 @@ def start(port=21, verbose=0, splash=True):
         if splash:
             print("FTP server started on {}:{}".format(ifconfig[0], port))
 
-    datasocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    datasocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    datasocket.bind(('0.0.0.0', _DATA_PORT))
-    datasocket.listen(1)
-    datasocket.settimeout(10)
+    # pool of passive data sockets, one is leased per session on PASV
+    for data_port in range(data_port, data_port + data_ports):
+        datasocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        datasocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        datasocket.bind(('0.0.0.0', data_port))
+        datasocket.listen(1)
+        datasocket.setsockopt(socket.SOL_SOCKET, _SO_REGISTER_HANDLER,
+                              data_accept)
+        datasockets.append((datasocket, data_port))
+    free_datasockets = datasockets[:]
+
 
-def restart(port=21, verbose=0, splash=True):
+def restart(port=21, verbose=0, splash=True, **kwargs):
     stop()
     sleep_ms(200)
-    start(port, verbose, splash)
+    start(port, verbose, splash, **kwargs)
 
 
-start(splash=True)
+# start in background on import, but not when uftpd_async imports
+# this module for FTP_client
+if "uftpd_async" not in sys.modules:
+    start(splash=True)
@@ -0,0 +1,297 @@
+#
+# Small ftp server for Micropython using asyncio
+#
+# The command logic is the one of FTP_client in uftpd.py. Each control
+# connection and each data transfer runs as its own task, such that the
+# server coexists with other asyncio tasks of the application.
+# Start the server with:
+#
+# import asyncio, uftpd_async
+# asyncio.create_task(uftpd_async.start([port = 21][, verbose = level]))
+#
+# and stop it with uftpd_async.stop(). The arguments of start() are the
+# same as of uftpd.start(). The server runs with CPython asyncio too, e.g.
+# for load tests on a PC, and then serves the file system of the PC:
+#
+# python3 uftpd_async.py [port]
+#
+# Distributed under MIT License
+#
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import sys
+import errno
+try:
+    from micropython import const
+except ImportError:  # CPython
+    def const(x):
+        return x
+import uftpd
+
+# constant definitions
+_COMMAND_TIMEOUT = const(300)
+_DATA_TIMEOUT = const(100)
+_ACCEPT_TIMEOUT = const(10)
+_CHUNK_MIN = const(512)
+_CHUNK_MAX = const(16384)
+_BUFFERS = const(2)
+_CACHE_SIZE = const(64)
+_CACHE_TTL = const(5000)
+_WRITE_SIZE = const(4096)
+_GC_FREE = const(8192)
+_DATA_PORT = const(13333)
+_DATA_PORTS = const(4)
+_STAT_DATA_FAIL = const(4)  # index of uftpd.stat_counts
+
+# Global variables
+server = None
+
+
+# Stream pair with the socket methods used by FTP_client. Writes are
+# buffered by the stream writer, and wait() flushes them, or reads more
+# data once readinto() has handed out all that was received.
+class Stream:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.line = b""  # the command line read by FTP_async_client.serve()
+        self.rbuf = b""
+        self.want_read = 0  # size of the read wait() has to do
+        self.eof = False
+        self.closed = False
+
+    # FTP_client.__init__ accepts the control connection from here
+    def accept(self):
+        return self, self.writer.get_extra_info("peername")
+
+    def readline(self):
+        return self.line
+
+    def readinto(self, buf):
+        if len(self.rbuf) > 0:
+            size = min(len(buf), len(self.rbuf))
+            buf[0:size] = self.rbuf[0:size]
+            self.rbuf = self.rbuf[size:]
+            if len(self.rbuf) == 0:
+                self.want_read = len(buf)
+            return size
+        if self.eof:
+            return 0
+        self.want_read = len(buf)
+        return None
+
+    def write(self, data):
+        # copy; the writer may keep the data after the buffer was reused
+        self.writer.write(data.encode() if isinstance(data, str)
+                          else bytes(data))
+        return len(data)
+
+    sendall = write
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def wait(self):
+        if self.want_read and not self.eof:
+            size, self.want_read = self.want_read, 0
+            self.rbuf = memoryview(await asyncio.wait_for(
+                self.reader.read(size), _DATA_TIMEOUT))
+            self.eof = len(self.rbuf) == 0
+        await self.writer.drain()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            asyncio.create_task(self.close_wait())
+
+    async def close_wait(self):
+        try:
+            await self.writer.drain()
+        except:
+            pass
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class FTP_async_client(uftpd.FTP_client):
+
+    def __init__(self, reader, writer, local_addr):
+        uftpd.FTP_client.__init__(self, Stream(reader, writer), local_addr)
+        self.data_event = asyncio.Event()
+        self.pending = None  # transfer waiting for the data connection
+
+    # serve the control connection
+    async def serve(self):
+        cl = self.command_client
+        try:
+            await cl.drain()
+            while not cl.closed:
+                try:
+                    cl.line = await asyncio.wait_for(cl.reader.readline(),
+                                                     _COMMAND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    cl.line = b""  # treated as QUIT
+                self.exec_ftp_command(cl)
+                if self.pending is not None and self.transfer is None:
+                    asyncio.create_task(self.run_transfer(*self.pending))
+                if not cl.closed:
+                    await cl.drain()
+        except Exception as err:
+            uftpd.log_msg(1, "Exception in serve:", err)
+        if not cl.closed:
+            uftpd.close_client(cl)
+
+    # the data connection is opened by run_transfer()
+    def start_transfer(self, cl, msg, transfer, path, *args):
+        if self.transfer is not None or self.pending is not None:
+            cl.sendall(uftpd.msg_425_busy)
+        elif self.lease_buffer() is None:
+            cl.sendall(uftpd.msg_450_no_buffer)
+            self.release_datasocket()
+        else:
+            self.pending = (msg, transfer, path, args)
+
+    async def run_transfer(self, msg, transfer, path, args):
+        cl = self.command_client
+        try:
+            data_client = await self.open_data_stream()
+        except Exception as err:
+            uftpd.log_msg(1, "Data connection failed:", err)
+            uftpd.stat_counts[_STAT_DATA_FAIL] += 1
+            self.pending = None
+            cl.sendall(uftpd.msg_550_fail)
+            self.release_datasocket()
+            self.release_buffer()
+            await cl.drain()
+            return
+        self.pending = None
+        self.data_client = data_client
+        cl.sendall(msg)
+        self.transfer = gen = self.open_transfer(transfer, path, data_client,
+                                                 args)
+        self.data_tick = self.transfer_tick = uftpd.ticks_ms()
+        self.transfer_bytes = 0
+        try:
+            await cl.drain()
+            while self.transfer is gen:
+                self.step_transfer()
+                if self.transfer is gen:
+                    await data_client.wait()
+        except Exception as err:
+            uftpd.log_msg(1, "Transfer failed:", err)
+            if self.transfer is gen:
+                self.end_transfer(uftpd.msg_550_fail)
+        if not cl.closed:
+            await cl.drain()
+
+    async def open_data_stream(self):
+        if self.block_client is not None:  # MODE B, connection kept
+            data_client, self.block_client = self.block_client, None
+            return data_client
+        if self.active:  # active mode
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.act_data_addr, self.DATA_PORT),
+                _DATA_TIMEOUT)
+            uftpd.log_msg(1, "FTP Data connection with:", self.act_data_addr)
+            return Stream(reader, writer)
+        if self.pasv_socket is None:
+            raise OSError(errno.EINVAL)  # no PASV before the transfer
+        while self.data_stream is None:  # the event may be of a closed one
+            self.data_event.clear()
+            await asyncio.wait_for(self.data_event.wait(), _ACCEPT_TIMEOUT)
+        data_client, self.data_stream = self.data_stream, None
+        return data_client
+
+
+# hand a passive data connection to the session which leased the port
+def data_accept(data_port):
+    def accept(reader, writer):
+        data_addr = writer.get_extra_info("peername")[0]
+        for client in uftpd.client_list:
+            if (client.pasv_socket is not None and
+                    client.pasv_socket[1] == data_port and
+                    client.remote_addr == data_addr and
+                    client.data_stream is None):
+                uftpd.log_msg(1, "FTP Data connection with:", data_addr)
+                client.data_stream = Stream(reader, writer)
+                client.data_event.set()
+                return
+        uftpd.log_msg(1, "Rejected data connection from:", data_addr)
+        Stream(reader, writer).close()
+    return accept
+
+
+async def accept_ftp_connect(reader, writer):
+    client = FTP_async_client(reader, writer, local_address(writer))
+    uftpd.client_list.append(client)
+    await client.serve()
+
+
+# the address for PASV replies
+def local_address(writer):
+    try:
+        return writer.get_extra_info("sockname")[0]
+    except:  # Micropython tells the peer address only
+        import network
+        for interface in [network.STA_IF, network.AP_IF]:
+            wlan = network.WLAN(interface)
+            if wlan.active():
+                return wlan.ifconfig()[0]
+        return "0.0.0.0"
+
+
+def stop():
+    global server
+
+    if server is not None:
+        server.close()
+        server = None
+    uftpd.stop()
+
+
+async def start(port=21, verbose=0, splash=True,
+                data_port=_DATA_PORT, data_ports=_DATA_PORTS,
+                chunk_min=_CHUNK_MIN, chunk_max=_CHUNK_MAX, buffers=_BUFFERS,
+                cache_size=_CACHE_SIZE, cache_ttl=_CACHE_TTL, list_sort=0,
+                write_size=_WRITE_SIZE, gc_free=_GC_FREE,
+                hash_index="/.hashindex"):
+    global server
+
+    uftpd.verbose_l = verbose
+    uftpd.chunk_min_l = chunk_min
+    uftpd.chunk_max_l = max(chunk_min, chunk_max)
+    uftpd.list_sort_l = list_sort
+    uftpd.write_size_l = write_size
+    uftpd.gc_free_l = gc_free
+    uftpd.hash_index_l = hash_index
+    uftpd.hash_entries = None
+    uftpd.alloc_buffer_pool(buffers)
+    uftpd.init_cache(cache_size, cache_ttl)
+    uftpd.client_list = []
+    # pool of passive data servers, one is leased per session on PASV
+    for data_port in range(data_port, data_port + data_ports):
+        data_server = await asyncio.start_server(data_accept(data_port),
+                                                 "0.0.0.0", data_port)
+        uftpd.datasockets.append((data_server, data_port))
+    uftpd.free_datasockets = uftpd.datasockets[:]
+    server = await asyncio.start_server(accept_ftp_connect, "0.0.0.0", port)
+    if splash:
+        print("FTP server started on port", port)
+
+
+if __name__ == "__main__":
+    async def main():
+        await start(int(sys.argv[1]) if len(sys.argv) > 1 else 21, 1)
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(main())